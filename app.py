@@ -1,14 +1,36 @@
 import os
 import json
+import heapq
+import itertools
+import atexit
+import sqlite3
+import hashlib
 import base64
 import io
-import itertools
+import re
+import shutil
+import binascii
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
+import time
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, render_template, jsonify, send_file, session, redirect, url_for
+from flask import Flask, request, render_template, jsonify, send_file, session, redirect, url_for, g, Response
 import requests
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
 from dotenv import load_dotenv
 import uuid
+import math
+import ipaddress
 from functools import wraps
+from contextlib import contextmanager, nullcontext
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow가 없으면 썸네일 생성과 업로드 축소 없이 원본만 사용
+    Image = ImageOps = None
 
 load_dotenv()
 
@@ -16,18 +38,16 @@ load_dotenv()
 API_BEARER_TOKEN = os.getenv('API_BEARER_TOKEN')
 API_KEY_ENV = os.getenv("API_KEY")
 API_URL_ENV = os.getenv("API_URL")
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com').rstrip('/')  # 키 사용 시 요청 주소 (벤치마크용 스텁 서버 지정 가능)
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash-image-preview')
 SITE_PASSWORD = os.getenv("SITE_PASSWORD", "default_password")
 ADMIN_KEY = os.getenv('ADMIN_KEY', 'default_admin_key')
 
 # --- 전역 변수 ---
-image_gallery = []
 user_sessions = {}
-banned_ips = set()  # 밴된 IP 목록
-image_creators = {}  # 이미지ID: IP 매핑
 
 # --- API 키 관리 ---
-API_KEYS = [k.strip() for k in API_KEY_ENV.split(",")] if API_KEY_ENV else []
-API_KEY_CYCLE = itertools.cycle(API_KEYS) if API_KEYS else None
+API_KEYS = [k.strip() for k in API_KEY_ENV.split(",") if k.strip()] if API_KEY_ENV else []
 
 # --- Flask 앱 설정 ---
 app = Flask(__name__)
@@ -45,15 +65,11 @@ app.config.update(
 )
 
 # 임시 디렉토리 사용
-UPLOAD_FOLDER = '/tmp/uploads'
-RESULT_FOLDER = '/tmp/results'
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', '/tmp/uploads')
+RESULT_FOLDER = os.getenv('RESULT_FOLDER', '/tmp/results')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULT_FOLDER, exist_ok=True)
 
-# 메모리에 저장할 데이터
-image_gallery = []
-like_records = {}
-
 # 한국 시간대 설정
 KST = timezone(timedelta(hours=9))
 
@@ -61,6 +77,1206 @@ def get_korean_time():
     """현재 한국 시간을 반환"""
     return datetime.now(KST)
 
+# --- 메트릭 (Prometheus 텍스트 형식) ---
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # 설정하면 /metrics에 Bearer 토큰 필요
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2, 20 * 1024 ** 2)
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+class Metric:
+    """라벨별 값을 증분으로 유지하는 메트릭 (스크레이프 비용은 시리즈 수에만 비례)"""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super().__init__(name, documentation, labelnames)
+        self.func = func  # 지정하면 스크레이프 시점 값 (O(1) 함수만 사용)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.func is not None:
+            with self._lock:
+                self._values[()] = self.func()
+        return super().render()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", bound))} {cumulative}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, ("le", "+Inf"))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics.register(Histogram(
+    'http_request_duration_seconds', 'Flask 라우트별 요청 처리 시간', ('route', 'method', 'status')))
+HTTP_REQUEST_BYTES = metrics.register(Histogram(
+    'http_request_size_bytes', '요청 본문(업로드) 크기', ('route',), SIZE_BUCKETS))
+HTTP_RESPONSE_BYTES = metrics.register(Histogram(
+    'http_response_size_bytes', '응답 본문 크기', ('route',), SIZE_BUCKETS))
+UPSTREAM_SECONDS = metrics.register(Histogram(
+    'upstream_request_duration_seconds', 'API 키(해시)별 업스트림 요청 시간', ('key', 'status')))
+UPSTREAM_REQUESTS = metrics.register(Counter(
+    'upstream_requests_total', 'API 키(해시)별 업스트림 응답 상태 코드', ('key', 'status')))
+GENERATIONS_IN_FLIGHT = metrics.register(Gauge(
+    'generations_in_flight', '진행 중인 이미지 생성 수'))
+GENERATION_QUEUE_DEPTH = metrics.register(Gauge(
+    'generation_queue_depth', '대기 중인 생성 작업 수', func=lambda: generation_jobs.stats()['queued']))
+GALLERY_IMAGES = metrics.register(Gauge(
+    'gallery_images', '갤러리 이미지 수', func=lambda: len(gallery_store)))
+GALLERY_LIKES = metrics.register(Gauge(
+    'gallery_likes', '갤러리 전체 좋아요 수', func=lambda: gallery_store.total_likes() + like_counter.pending_total()))
+
+def key_label(key):
+    """메트릭 라벨용 API 키 해시 (원본 키 노출 방지)"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]
+
+# --- 단계별 처리 시간 (Server-Timing / 느린 요청 기록) ---
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'false').lower() in ('1', 'true', 'yes')  # 응답 헤더로 노출
+SLOW_LOG_CAPACITY = int(os.getenv('SLOW_LOG_CAPACITY', 1000))   # 최근 요청 타이밍 보관 개수 (링 버퍼)
+
+class PhaseTimer:
+    """요청 하나의 단계별 소요 시간을 누적 (여러 스레드에서 기록 가능)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.queued_at = None
+        self.finished = None
+        self.info = {}
+        self._phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._phases[name] = self._phases.get(name, 0.0) + seconds
+
+    def phases(self):
+        with self._lock:
+            return OrderedDict(self._phases)
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def header(self):
+        """Server-Timing 헤더 값"""
+        metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases().items()]
+        metrics.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ', '.join(metrics)
+
+class SlowRequestLog:
+    """최근 요청 타이밍을 링 버퍼에 보관하고 조회 시 가장 느린 N개를 반환"""
+
+    def __init__(self, capacity):
+        self._entries = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def record(self, timer, status_code):
+        entry = {
+            'name': timer.name,
+            'status': status_code,
+            'finished_at': get_korean_time().isoformat(),
+            'total_ms': round(timer.elapsed() * 1000, 1),
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in timer.phases().items()}
+        }
+        entry.update(timer.info)
+        with self._lock:
+            self._entries.append(entry)
+
+    def slowest(self, limit):
+        with self._lock:
+            entries = list(self._entries)
+        return heapq.nlargest(limit, entries, key=lambda entry: entry['total_ms'])
+
+slow_requests = SlowRequestLog(SLOW_LOG_CAPACITY)
+
+def timed_phase(timer, name):
+    """timer가 없으면 아무것도 재지 않는 컨텍스트"""
+    return timer.phase(name) if timer is not None else nullcontext()
+
+# --- 갤러리 저장소 ---
+GALLERY_SORTS = ('newest', 'oldest', 'likes')
+MAX_PER_PAGE = 100
+
+class InvalidCursor(ValueError):
+    """잘못된 페이지네이션 커서"""
+
+def encode_cursor(sort_by, key):
+    """정렬 기준과 마지막 항목의 정렬 키를 불투명 커서 문자열로 변환"""
+    raw = json.dumps({'s': sort_by, 'k': key}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort_by):
+    """커서 문자열을 정렬 키로 복원 (정렬 기준이 다르면 거부)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        key = data['k']
+        if data['s'] != sort_by:
+            raise InvalidCursor('정렬 기준이 커서와 다릅니다.')
+        if sort_by == 'likes':
+            return (int(key[0]), int(key[1]))
+        return int(key)
+    except InvalidCursor:
+        raise
+    except Exception:
+        raise InvalidCursor('잘못된 커서입니다.')
+
+GALLERY_DB_PATH = os.getenv('GALLERY_DB_PATH', '/tmp/gallery.db')
+ITEM_COLUMNS = ('id', 'created_at', 'likes', 'creator_ip')  # 나머지 필드는 data(JSON) 컬럼에 저장
+
+GALLERY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,   -- 생성 순서 (created_at 순서와 동일)
+    id TEXT NOT NULL UNIQUE,
+    created_at TEXT NOT NULL,
+    likes INTEGER NOT NULL DEFAULT 0,
+    creator_ip TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_created_at ON images(created_at);
+CREATE INDEX IF NOT EXISTS idx_images_likes ON images(likes DESC, seq);
+CREATE INDEX IF NOT EXISTS idx_images_creator_ip ON images(creator_ip);
+CREATE TABLE IF NOT EXISTS likes (
+    ip TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (ip, image_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS banned_ips (
+    ip TEXT PRIMARY KEY,
+    banned_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_refs (
+    filename TEXT PRIMARY KEY,
+    refcount INTEGER NOT NULL
+);
+-- 프롬프트/응답 전문 검색 (rowid = images.seq, 한글 등은 search_text()로 바이그램 변환해 저장)
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+    prompt, response_text, tokenize='porter unicode61 remove_diacritics 2'
+);
+"""
+
+# --- 검색어 토큰화 (한글/CJK는 글자 바이그램, 영문은 FTS5 unicode61 + porter 어간 추출) ---
+SEARCH_SORTS = ('relevance', 'newest', 'likes')
+SEARCH_MAX_QUERY = 200
+CJK_RUN = re.compile(r'[\u1100-\u11ff\u3040-\u30ff\u3130-\u318f\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7a3]+')
+SEARCH_WORD = re.compile(r'\w+')
+
+def cjk_bigrams(run):
+    """'고양이가' -> ['고양', '양이', '이가'] (한 글자면 그대로)"""
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+def search_text(text):
+    """색인용 텍스트: 띄어쓰기와 조사에 관계없이 부분 일치하도록 CJK 구간을 바이그램으로 풀어 씀"""
+    if not text:
+        return ''
+    return CJK_RUN.sub(lambda m: ' ' + ' '.join(cjk_bigrams(m.group())) + ' ', text)
+
+def fts_query(query):
+    """사용자 검색어를 FTS5 MATCH 식으로 변환 (모든 단어 AND, 없으면 None)
+
+    CJK 단어는 바이그램 구문("고양 양이")으로, 한 글자는 접두어 검색으로,
+    마지막 영문 단어는 입력 중인 단어를 위해 접두어 검색으로 바꾼다.
+    """
+    terms = []
+    words = SEARCH_WORD.findall(query[:SEARCH_MAX_QUERY])
+    for index, word in enumerate(words):
+        pieces = []
+        position = 0
+        for match in CJK_RUN.finditer(word):
+            if match.start() > position:
+                pieces.append((word[position:match.start()], False))
+            pieces.append((match.group(), True))
+            position = match.end()
+        if position < len(word):
+            pieces.append((word[position:], False))
+        for piece, is_cjk in pieces:
+            if is_cjk and len(piece) == 1:
+                terms.append(f'"{piece}"*')
+            elif is_cjk:
+                terms.append('"' + ' '.join(cjk_bigrams(piece)) + '"')
+            elif index == len(words) - 1:
+                terms.append(f'"{piece}"*')
+            else:
+                terms.append(f'"{piece}"')
+    return ' AND '.join(terms) if terms else None
+
+# --- 갤러리 변경 피드 (since 커서 / SSE) ---
+GALLERY_FEED_SIZE = int(os.getenv('GALLERY_FEED_SIZE', 10000))            # 보관할 최근 변경 이벤트 수
+GALLERY_STREAM_MAX = int(os.getenv('GALLERY_STREAM_MAX', 100))            # 동시 SSE 연결 수 (연결마다 스레드 1개 점유)
+GALLERY_STREAM_KEEPALIVE = float(os.getenv('GALLERY_STREAM_KEEPALIVE', 15))  # 이벤트가 없을 때 keep-alive 주석 간격(초)
+GALLERY_STREAM_MAX_AGE = float(os.getenv('GALLERY_STREAM_MAX_AGE', 300))  # 연결 최대 유지 시간(초), 이후 브라우저가 Last-Event-ID로 재연결
+
+class GalleryFeed:
+    """갤러리 변경 이벤트(added / deleted / likes)를 링 버퍼에 보관하고 커서 이후 변경분만 제공
+
+    커서는 (프로세스 시작 ID, 이벤트 번호)를 담은 불투명 문자열이다. 재시작 전 커서나 버퍼에서
+    이미 밀려난 커서는 변경분 대신 reset으로 응답해 클라이언트가 첫 페이지부터 다시 읽게 한다.
+    """
+
+    def __init__(self, capacity):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._events = deque(maxlen=capacity)   # (이벤트 번호, 종류, 내용)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def publish(self, kind, payloads):
+        with self._cond:
+            for payload in payloads:
+                self._seq += 1
+                self._events.append((self._seq, kind, payload))
+            self._cond.notify_all()
+
+    @property
+    def head(self):
+        """마지막으로 발행된 이벤트 번호"""
+        return self._seq
+
+    def cursor(self, seq=None):
+        if seq is None:
+            seq = self._seq
+        raw = json.dumps({'b': self.boot_id, 'e': seq}, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    def decode(self, cursor):
+        """커서를 이벤트 번호로 복원 (다른 프로세스에서 발급된 커서면 None)"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            boot_id, seq = data['b'], int(data['e'])
+        except Exception:
+            raise InvalidCursor('잘못된 커서입니다.')
+        return seq if boot_id == self.boot_id else None
+
+    def events_after(self, seq):
+        """seq 이후 이벤트 목록 (이어 줄 수 없으면 None)"""
+        with self._cond:
+            if seq is None or seq > self._seq:
+                return None
+            first = self._events[0][0] if self._events else self._seq + 1
+            if seq < first - 1:
+                return None
+            return list(itertools.islice(self._events, seq - first + 1, None))
+
+    def wait(self, seq, timeout):
+        """seq 이후 이벤트가 생기거나 timeout이 지날 때까지 대기"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._seq > seq, timeout)
+
+    def delta(self, seq):
+        """seq 이후 변경분을 항목별 최종 상태로 합침 (이어 줄 수 없으면 None)
+
+        반환값: {'added': [항목], 'deleted': [id], 'likes': {id: 좋아요 수}, 'cursor': 다음 커서}
+        """
+        events = self.events_after(seq)
+        if events is None:
+            return None
+        added = OrderedDict()
+        deleted = set()
+        likes = {}
+        for _, kind, payload in events:
+            if kind == 'added':
+                added[payload['id']] = dict(payload)
+            elif kind == 'deleted':
+                added.pop(payload, None)
+                likes.pop(payload, None)
+                deleted.add(payload)
+            elif kind == 'likes':
+                image_id, count = payload
+                if image_id in added:
+                    added[image_id]['likes'] = count
+                else:
+                    likes[image_id] = count
+        return {
+            'added': list(added.values()),
+            'deleted': sorted(deleted),
+            'likes': likes,
+            'cursor': self.cursor(events[-1][0] if events else seq)
+        }
+
+gallery_feed = GalleryFeed(GALLERY_FEED_SIZE)
+
+class GalleryStore:
+    """SQLite(WAL) 기반 갤러리 저장소
+
+    - 최신/오래된 순: seq(INTEGER PRIMARY KEY) 순서 = created_at 순서, 키셋 페이지네이션
+    - 좋아요 순: (likes DESC, seq) 인덱스로 키셋 페이지네이션
+    - 조회: id(UNIQUE) 기본 인덱스와 creator_ip 보조 인덱스
+    시작 시 전체 이력을 메모리에 올리지 않고 항목 수만 읽어 둔다.
+    feed가 있으면 커밋된 추가/삭제/좋아요 수 변경을 이벤트로 발행한다.
+    """
+
+    def __init__(self, path, feed=None):
+        self.path = path
+        self.feed = feed
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        has_search_index = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'images_fts'").fetchone() is not None
+        conn.executescript(GALLERY_SCHEMA)
+        if not has_search_index:
+            # 검색 색인이 없던 DB는 기존 항목으로 한 번 채움
+            self._write(lambda conn: self._index_after(conn, 0))
+        # 항목 수와 전체 좋아요 수는 시작 시 한 번 읽고 이후 쓰기마다 증분 갱신
+        self._count, self._total_likes = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(likes), 0) FROM images').fetchone()
+
+    def _conn(self):
+        # 스레드마다 연결 하나 (sqlite3 연결은 스레드 간 공유하지 않음)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('search_text', 1, search_text, deterministic=True)
+            self._local.conn = conn
+        return conn
+
+    def _write(self, func, on_commit=None):
+        """쓰기 트랜잭션 실행 (쓰기는 프로세스 내에서 직렬화)
+
+        on_commit(결과)은 커밋 직후 쓰기 락 안에서 호출되어, 피드 이벤트가 커밋 순서대로 발행된다.
+        """
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(conn)
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            if on_commit is not None:
+                on_commit(result)
+            return result
+
+    def _publish(self, kind, payloads):
+        if self.feed is not None and payloads:
+            self.feed.publish(kind, payloads)
+
+    @staticmethod
+    def _item(row):
+        item = json.loads(row['data'])
+        for column in ITEM_COLUMNS:
+            item[column] = row[column]
+        return item
+
+    def __len__(self):
+        return self._count
+
+    def get(self, image_id):
+        """image_id로 항목 조회 (없으면 None)"""
+        row = self._conn().execute('SELECT * FROM images WHERE id = ?', (image_id,)).fetchone()
+        return self._item(row) if row else None
+
+    def total_likes(self):
+        return self._total_likes
+
+    def add(self, item):
+        self.add_many([item])
+
+    def add_many(self, items):
+        """여러 항목을 한 트랜잭션으로 추가 (대량 가져오기, 벤치마크 시드용)"""
+        rows = [
+            (item['id'], item['created_at'], item['likes'], item.get('creator_ip'),
+             json.dumps({k: v for k, v in item.items() if k not in ITEM_COLUMNS}, ensure_ascii=False))
+            for item in items
+        ]
+        def apply(conn):
+            last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM images').fetchone()[0]
+            conn.executemany(
+                'INSERT INTO images (id, created_at, likes, creator_ip, data) VALUES (?, ?, ?, ?, ?)', rows)
+            self._index_after(conn, last_seq)
+            self._count += len(rows)
+            self._total_likes += sum(row[2] for row in rows)
+        self._write(apply, lambda _: self._publish('added', [dict(item) for item in items]))
+
+    @staticmethod
+    def _index_after(conn, last_seq):
+        # 쓰기는 직렬화되어 있으므로 seq가 last_seq보다 큰 행이 방금 추가된 행
+        conn.execute(
+            "INSERT INTO images_fts (rowid, prompt, response_text) "
+            "SELECT seq, search_text(json_extract(data, '$.prompt')), search_text(json_extract(data, '$.response_text')) "
+            "FROM images WHERE seq > ?", (last_seq,))
+
+    def update_fields(self, image_id, fields):
+        """항목의 data(JSON) 필드 일부를 덮어씀 (항목이 이미 삭제됐으면 False)"""
+        patch = json.dumps(fields, ensure_ascii=False)
+        return self._write(lambda conn: conn.execute(
+            'UPDATE images SET data = json_patch(data, ?) WHERE id = ?', (patch, image_id)).rowcount > 0)
+
+    def likes_of(self, image_id):
+        """저장된 좋아요 수 (항목이 없으면 None)"""
+        row = self._conn().execute('SELECT likes FROM images WHERE id = ?', (image_id,)).fetchone()
+        return row['likes'] if row else None
+
+    def apply_likes(self, pairs):
+        """모아 둔 (ip, image_id) 좋아요 기록을 한 트랜잭션으로 반영
+
+        좋아요 수는 실제로 새로 기록된 (ip, image_id) 행 수만큼만 올려 중복 좋아요가 세어지지 않게 한다.
+        """
+        def apply(conn):
+            deltas = {}
+            for ip, image_id in pairs:
+                inserted = conn.execute(
+                    'INSERT OR IGNORE INTO likes (ip, image_id) '
+                    'SELECT ?, id FROM images WHERE id = ?', (ip, image_id)).rowcount
+                if inserted:
+                    deltas[image_id] = deltas.get(image_id, 0) + 1
+            changed = []
+            for image_id, delta in deltas.items():
+                updated = conn.execute('UPDATE images SET likes = likes + ? WHERE id = ?',
+                                       (delta, image_id)).rowcount
+                self._total_likes += delta * updated
+                if updated:
+                    changed.append(image_id)
+            counts = []
+            for i in range(0, len(changed), 500):
+                chunk = changed[i:i + 500]
+                counts += [(row['id'], row['likes']) for row in conn.execute(
+                    f"SELECT id, likes FROM images WHERE id IN ({','.join('?' * len(chunk))})", chunk)]
+            return counts
+        self._write(apply, lambda counts: self._publish('likes', counts))
+
+    def has_liked(self, client_ip, image_id):
+        return self._conn().execute('SELECT 1 FROM likes WHERE ip = ? AND image_id = ?',
+                                    (client_ip, image_id)).fetchone() is not None
+
+    def liked_ids(self, client_ip, image_ids):
+        """image_ids 중 해당 IP가 좋아요한 id 집합"""
+        image_ids = list(image_ids)
+        if not image_ids:
+            return set()
+        placeholders = ','.join('?' * len(image_ids))
+        rows = self._conn().execute(
+            f'SELECT image_id FROM likes WHERE ip = ? AND image_id IN ({placeholders})',
+            [client_ip] + image_ids)
+        return {row['image_id'] for row in rows}
+
+    def remove_many(self, image_ids):
+        """여러 항목을 한 트랜잭션으로 제거하고 제거된 항목 목록 반환"""
+        image_ids = list(set(image_ids))
+        def apply(conn):
+            removed = []
+            for i in range(0, len(image_ids), 500):
+                chunk = image_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                removed += [self._item(row) for row in conn.execute(
+                    f'SELECT * FROM images WHERE id IN ({placeholders})', chunk)]
+                conn.execute(
+                    f'DELETE FROM images_fts WHERE rowid IN (SELECT seq FROM images WHERE id IN ({placeholders}))', chunk)
+                conn.execute(f'DELETE FROM images WHERE id IN ({placeholders})', chunk)
+                conn.execute(f'DELETE FROM likes WHERE image_id IN ({placeholders})', chunk)
+            self._count -= len(removed)
+            self._total_likes -= sum(item['likes'] for item in removed)
+            return removed
+        if not image_ids:
+            return []
+        return self._write(apply, lambda removed: self._publish('deleted', [item['id'] for item in removed]))
+
+    def oldest_ids(self, limit, created_before=None):
+        """가장 오래된 image_id부터 limit개 (created_before가 있으면 그보다 먼저 생성된 것만)"""
+        if created_before is None:
+            rows = self._conn().execute('SELECT id FROM images ORDER BY seq LIMIT ?', (limit,))
+        else:
+            rows = self._conn().execute(
+                'SELECT id FROM images WHERE created_at < ? ORDER BY created_at LIMIT ?', (created_before, limit))
+        return [row['id'] for row in rows]
+
+    def banned_ips(self):
+        return {row['ip'] for row in self._conn().execute('SELECT ip FROM banned_ips')}
+
+    def add_bans(self, ips):
+        banned_at = get_korean_time().isoformat()
+        self._write(lambda conn: conn.executemany(
+            'INSERT OR IGNORE INTO banned_ips (ip, banned_at) VALUES (?, ?)',
+            [(ip, banned_at) for ip in ips]))
+
+    def adjust_upload_ref(self, filename, delta):
+        """업로드 파일 참조 수를 delta만큼 바꾸고 새 참조 수 반환 (0 이하면 행 삭제)"""
+        def apply(conn):
+            row = conn.execute('SELECT refcount FROM upload_refs WHERE filename = ?', (filename,)).fetchone()
+            count = (row['refcount'] if row else 0) + delta
+            if count > 0:
+                conn.execute('INSERT OR REPLACE INTO upload_refs (filename, refcount) VALUES (?, ?)',
+                             (filename, count))
+            else:
+                conn.execute('DELETE FROM upload_refs WHERE filename = ?', (filename,))
+            return count
+        return self._write(apply)
+
+    def cursor_for(self, sort_by, item):
+        """항목 바로 다음부터 이어지는 페이지를 가리키는 커서 생성"""
+        row = self._conn().execute('SELECT seq, likes FROM images WHERE id = ?', (item['id'],)).fetchone()
+        if row is None:
+            return None
+        if sort_by == 'likes':
+            return encode_cursor(sort_by, [item['likes'], row['seq']])
+        return encode_cursor(sort_by, row['seq'])
+
+    def _select(self, where, params, order, limit):
+        rows = self._conn().execute(
+            f'SELECT * FROM images {where} ORDER BY {order} LIMIT ?', list(params) + [limit])
+        return [self._item(row) for row in rows]
+
+    def search(self, query, sort_by, offset, limit):
+        """전문 검색 페이지: (항목 목록, 다음 페이지 존재 여부, 전체 일치 수)
+
+        relevance는 bm25 점수(프롬프트 가중치 2배) 순, 같은 점수는 최신 순.
+        """
+        match = fts_query(query)
+        if match is None:
+            return [], False, 0
+        order = {
+            'newest': 'images_fts.rowid DESC',
+            'likes': 'images.likes DESC, images.seq'
+        }.get(sort_by, 'bm25(images_fts, 2.0, 1.0), images_fts.rowid DESC')
+        conn = self._conn()
+        rows = conn.execute(
+            'SELECT images.* FROM images_fts JOIN images ON images.seq = images_fts.rowid '
+            f'WHERE images_fts MATCH ? ORDER BY {order} LIMIT ? OFFSET ?', (match, limit + 1, offset)).fetchall()
+        total = conn.execute('SELECT COUNT(*) FROM images_fts WHERE images_fts MATCH ?', (match,)).fetchone()[0]
+        return [self._item(row) for row in rows[:limit]], len(rows) > limit, total
+
+    def page(self, sort_by, offset, limit):
+        """오프셋 기반 페이지: (항목 목록, 다음 페이지 존재 여부)"""
+        order = {'oldest': 'seq', 'likes': 'likes DESC, seq'}.get(sort_by, 'seq DESC')
+        rows = self._conn().execute(
+            f'SELECT * FROM images ORDER BY {order} LIMIT ? OFFSET ?', (limit + 1, offset)).fetchall()
+        return [self._item(row) for row in rows[:limit]], len(rows) > limit
+
+    def page_after(self, sort_by, cursor, limit):
+        """커서 기반(키셋) 페이지: 인덱스 범위 탐색으로 O(limit)
+
+        반환값: (항목 목록, 다음 커서 또는 None)
+        """
+        fetch = limit + 1
+        if sort_by == 'oldest':
+            items = self._select('WHERE seq > ?', (cursor if cursor is not None else -1,), 'seq', fetch)
+        elif sort_by == 'likes':
+            if cursor is None:
+                items = self._select('', (), 'likes DESC, seq', fetch)
+            else:
+                likes, seq = cursor
+                # 같은 좋아요 수의 나머지 → 더 적은 좋아요 순으로, 두 범위 모두 인덱스 사용
+                items = self._select('WHERE likes = ? AND seq > ?', (likes, seq), 'seq', fetch)
+                if len(items) < fetch:
+                    items += self._select('WHERE likes < ?', (likes,), 'likes DESC, seq', fetch - len(items))
+        else:  # newest
+            if cursor is None:
+                items = self._select('', (), 'seq DESC', fetch)
+            else:
+                items = self._select('WHERE seq < ?', (cursor,), 'seq DESC', fetch)
+        page_items = items[:limit]
+        next_cursor = None
+        if len(items) > limit and page_items:
+            next_cursor = self.cursor_for(sort_by, page_items[-1])
+        return page_items, next_cursor
+
+gallery_store = GalleryStore(GALLERY_DB_PATH, gallery_feed)
+
+# --- 좋아요 카운터 (write-behind) ---
+LIKE_FLUSH_INTERVAL = float(os.getenv('LIKE_FLUSH_INTERVAL', 1.0))   # 저장소 반영 주기(초)
+LIKE_FLUSH_BATCH = int(os.getenv('LIKE_FLUSH_BATCH', 500))           # 이만큼 쌓이면 주기 전에 반영
+
+class LikeCounter:
+    """좋아요를 락 안에서 원자적으로 집계하고, 모아서 저장소와 정렬 인덱스에 일괄 반영
+
+    IP별 중복 방지는 아직 반영되지 않은 IP -> image_id 집합과 저장소의 likes 테이블로 판정한다.
+    반영은 대기 중인 집계를 떼어 낸 뒤 락 밖에서 쓰므로 읽기 요청이 커밋을 기다리지 않는다.
+    """
+
+    def __init__(self, store, flush_interval, flush_batch):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()   # 반영은 한 번에 하나씩
+        self._pending = {}      # ip -> 반영 대기 중인 image_id 집합
+        self._deltas = {}       # image_id -> 반영 대기 중인 증가량
+        self._pending_count = 0
+        # 저장소에 쓰는 중인 집계 (커밋될 때까지 중복 판정과 좋아요 수에 포함)
+        self._flushing = {}
+        self._flushing_deltas = {}
+        self._flushing_count = 0
+        self._flushes = 0       # 완료된 반영 횟수 (락 밖 조회 사이에 커밋이 끼었는지 확인용)
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _ensure_flusher(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='like-flusher', daemon=True)
+            self._thread.start()
+
+    def _is_pending(self, client_ip, image_id):
+        return image_id in self._pending.get(client_ip, ()) or image_id in self._flushing.get(client_ip, ())
+
+    def like(self, client_ip, image_id):
+        """IP당 한 번만 좋아요: ('ok', 새 좋아요 수) / ('already', None) / ('missing', None)"""
+        with self._lock:
+            self._ensure_flusher()
+            if self._is_pending(client_ip, image_id):
+                return 'already', None
+            flushes = self._flushes
+        # 저장소 조회는 락 밖에서
+        stored_likes = self.store.likes_of(image_id)
+        if stored_likes is None:
+            return 'missing', None
+        if self.store.has_liked(client_ip, image_id):
+            return 'already', None
+        with self._lock:
+            # 같은 IP의 동시 요청이 먼저 기록했을 수 있으므로 다시 확인
+            if self._is_pending(client_ip, image_id):
+                return 'already', None
+            # 조회 사이에 반영이 커밋됐다면 그 기록은 대기 목록에서 빠졌으므로 저장소를 다시 확인
+            if self._flushes != flushes and self.store.has_liked(client_ip, image_id):
+                return 'already', None
+            self._pending.setdefault(client_ip, set()).add(image_id)
+            self._deltas[image_id] = self._deltas.get(image_id, 0) + 1
+            self._pending_count += 1
+            likes = stored_likes + self._deltas[image_id] + self._flushing_deltas.get(image_id, 0)
+        if self._pending_count >= self.flush_batch:
+            self._wakeup.set()
+        return 'ok', likes
+
+    def pending_delta(self, image_id):
+        """아직 저장소에 반영되지 않은 좋아요 수"""
+        return self._deltas.get(image_id, 0) + self._flushing_deltas.get(image_id, 0)
+
+    def pending_total(self):
+        """아직 저장소에 반영되지 않은 전체 좋아요 수"""
+        return self._pending_count + self._flushing_count
+
+    def pending_ids(self, client_ip):
+        """해당 IP의 반영 대기 중인 좋아요 image_id 집합"""
+        with self._lock:
+            return set(self._pending.get(client_ip, ())) | self._flushing.get(client_ip, set())
+
+    def has_liked(self, client_ip, image_id):
+        return self._is_pending(client_ip, image_id) or self.store.has_liked(client_ip, image_id)
+
+    def flush(self):
+        """대기 중인 좋아요를 떼어 내 한 트랜잭션으로 반영 (실패하면 다음 반영에 다시 합침)"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending_count:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                self._flushing_deltas, self._deltas = self._deltas, {}
+                self._flushing_count, self._pending_count = self._pending_count, 0
+            pairs = [(ip, image_id) for ip, ids in self._flushing.items() for image_id in ids]
+            failed = False
+            try:
+                self.store.apply_likes(pairs)
+            except Exception as e:
+                print(f"❌ 좋아요 반영 실패: {e}")
+                failed = True
+            with self._lock:
+                if failed:
+                    for ip, ids in self._flushing.items():
+                        self._pending.setdefault(ip, set()).update(ids)
+                    for image_id, delta in self._flushing_deltas.items():
+                        self._deltas[image_id] = self._deltas.get(image_id, 0) + delta
+                    self._pending_count += self._flushing_count
+                self._flushing = {}
+                self._flushing_deltas = {}
+                self._flushing_count = 0
+                self._flushes += 1
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+like_counter = LikeCounter(gallery_store, LIKE_FLUSH_INTERVAL, LIKE_FLUSH_BATCH)
+atexit.register(like_counter.flush)
+
+# --- 사용자 콘텐츠 위치 인덱스 ---
+USER_CONTENT_MAX_AGE = int(os.getenv('USER_CONTENT_MAX_AGE', 365 * 24 * 3600))  # 파일명이 바뀌지 않으므로 장기 캐시
+USER_CONTENT_CACHE_PUBLIC = os.getenv('USER_CONTENT_CACHE_PUBLIC', 'false').lower() in ('1', 'true', 'yes')  # CDN 캐시 허용
+CONTENT_INDEX_SIZE = int(os.getenv('CONTENT_INDEX_SIZE', 50000))
+
+class ContentIndex:
+    """파일명 -> 실제 경로 LRU 인덱스 (파일 저장 시 등록, 미스일 때만 디스크 확인)"""
+
+    def __init__(self, folders, max_entries):
+        self._lock = threading.Lock()
+        self._paths = OrderedDict()
+        self.folders = folders
+        self.max_entries = max_entries
+
+    def register(self, path):
+        with self._lock:
+            self._paths[os.path.basename(path)] = path
+            self._paths.move_to_end(os.path.basename(path))
+            while len(self._paths) > self.max_entries:
+                self._paths.popitem(last=False)
+
+    def unregister(self, path):
+        with self._lock:
+            self._paths.pop(os.path.basename(path), None)
+
+    def lookup(self, filename):
+        """파일 경로 반환 (없으면 None)"""
+        with self._lock:
+            path = self._paths.get(filename)
+            if path is not None:
+                self._paths.move_to_end(filename)
+                return path
+        for folder in self.folders:
+            path = os.path.join(folder, filename)
+            if os.path.isfile(path):
+                self.register(path)
+                return path
+        return None
+
+content_index = ContentIndex((UPLOAD_FOLDER, RESULT_FOLDER), CONTENT_INDEX_SIZE)
+
+# --- 업로드 이미지 전처리 (실제 형식 판별 / 축소·재압축) ---
+UPLOAD_MAX_DIMENSION = int(os.getenv('UPLOAD_MAX_DIMENSION', 2048))      # 긴 변 최대 픽셀, 0이면 해상도 제한 없음
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 4 * 1024 * 1024))   # 이보다 크면 재압축, 0이면 크기 제한 없음
+UPLOAD_JPEG_QUALITY = int(os.getenv('UPLOAD_JPEG_QUALITY', 88))
+# 재인코딩 대상 (GIF는 애니메이션, SVG는 벡터라 그대로 전달)
+RECOMPRESSIBLE_TYPES = {'image/png', 'image/jpeg', 'image/webp', 'image/bmp', 'image/tiff'}
+
+def sniff_image_type(head):
+    """파일 앞부분의 매직 바이트로 실제 이미지 MIME 타입 판별 (모르면 None)"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.startswith(b'BM'):
+        return 'image/bmp'
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'image/tiff'
+    text = head[:1024].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if text.startswith(b'<svg') or (text.startswith(b'<?xml') and b'<svg' in text):
+        return 'image/svg+xml'
+    return None
+
+def preprocess_upload(stream):
+    """해상도나 크기 예산을 넘는 업로드를 축소/재압축
+
+    stream은 업로드 파일 객체 (예산 안이면 읽지 않고 그대로 돌려줌)
+    반환값: (업스트림에 보낼 파일 객체, 실제 MIME 타입)
+    """
+    stream.seek(0)
+    mime_type = sniff_image_type(stream.read(1024))
+    stream.seek(0, 2)
+    original_size = stream.tell()
+    stream.seek(0)
+    if Image is None or mime_type not in RECOMPRESSIBLE_TYPES:
+        return stream, mime_type
+
+    with Image.open(stream) as image:
+        # 헤더만 읽은 상태에서 판단 (예산 안이면 디코딩하지 않음)
+        width, height = image.size
+        too_large = UPLOAD_MAX_DIMENSION and max(width, height) > UPLOAD_MAX_DIMENSION
+        too_heavy = UPLOAD_MAX_BYTES and original_size > UPLOAD_MAX_BYTES
+        if not too_large and not too_heavy:
+            stream.seek(0)
+            return stream, mime_type
+
+        if too_large:
+            # JPEG는 디코딩 단계에서 1/2^n 축소 (전체 해상도로 풀지 않음)
+            scale = UPLOAD_MAX_DIMENSION / max(width, height)
+            image.draft('RGB', (int(width * scale) + 1, int(height * scale) + 1))
+        image = ImageOps.exif_transpose(image)
+        if too_large:
+            image.thumbnail((UPLOAD_MAX_DIMENSION, UPLOAD_MAX_DIMENSION), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            # 투명도가 있으면 WebP로 (JPEG는 알파 채널 없음)
+            image.convert('RGBA').save(buffer, 'WEBP', quality=UPLOAD_JPEG_QUALITY, method=4)
+            new_type = 'image/webp'
+        else:
+            image.convert('RGB').save(buffer, 'JPEG', quality=UPLOAD_JPEG_QUALITY, optimize=True)
+            new_type = 'image/jpeg'
+        new_size = image.size
+
+    if not too_large and buffer.tell() >= original_size:
+        # 재압축해도 줄지 않으면 원본 유지
+        stream.seek(0)
+        return stream, mime_type
+    print(f"🗜️ 업로드 축소: {width}x{height} {round(original_size/(1024*1024), 2)}MB → "
+          f"{new_size[0]}x{new_size[1]} {round(buffer.tell()/(1024*1024), 2)}MB")
+    buffer.seek(0)
+    return buffer, new_type
+
+# --- 내용 주소 기반 업로드 저장소 ---
+STREAM_CHUNK_SIZE = 192 * 1024   # 파일 복사/base64 스트리밍 단위 (3의 배수라 청크별 인코딩 결과를 그대로 이어 붙일 수 있음)
+UPLOAD_EXTENSIONS = {
+    'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/bmp': 'bmp',
+    'image/webp': 'webp', 'image/tiff': 'tiff', 'image/svg+xml': 'svg'
+}
+
+class UploadStore:
+    """업로드 이미지를 SHA-256 내용 해시로 한 번만 저장하고 갤러리 항목 간 참조 수를 관리
+
+    참조 수는 갤러리 저장소(upload_refs 테이블)에 영속화된다.
+    업스트림으로 보낼 때는 저장된 파일을 읽으며 base64로 스트리밍 인코딩한다 (StreamingBody).
+    """
+
+    def __init__(self, folder, db):
+        self.folder = folder
+        self.db = db
+        self._lock = threading.Lock()
+
+    def store(self, source, mime_type):
+        """저장(또는 기존 파일 재사용) 후 참조 1개를 잡고 (파일명, 경로) 반환
+
+        source는 bytes 또는 파일 객체 (청크 단위로 해시하며 임시 파일에 복사해 전체를 메모리에 올리지 않음)
+        """
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.folder, f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = source.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            filename = f"{digest.hexdigest()}.{UPLOAD_EXTENSIONS.get(mime_type, 'png')}"
+            path = os.path.join(self.folder, filename)
+            with self._lock:
+                self.db.adjust_upload_ref(filename, 1)
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+                    storage_manager.track(size)
+                content_index.register(path)
+            return filename, path
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def retain(self, filenames, count=1):
+        """파일마다 참조 count개 추가"""
+        with self._lock:
+            for filename in filenames:
+                self.db.adjust_upload_ref(filename, count)
+
+    def release(self, filenames):
+        """파일마다 참조 1개 해제, 참조가 없어진 파일은 삭제"""
+        with self._lock:
+            for filename in filenames:
+                if self.db.adjust_upload_ref(filename, -1) > 0:
+                    continue
+                storage_manager.remove_file(os.path.join(self.folder, filename))
+
+upload_store = UploadStore(UPLOAD_FOLDER, gallery_store)
+
+def upload_filenames(uploaded_images):
+    """갤러리 항목의 uploaded_images에서 저장소 파일명 목록 추출"""
+    return [img['path'].replace('/user_content/', '') for img in uploaded_images or []]
+
+# --- 갤러리용 파생 이미지 (썸네일 / WebP) ---
+THUMBNAIL_WIDTH = int(os.getenv('THUMBNAIL_WIDTH', 480))      # 그리드 타일용
+DISPLAY_WIDTH = int(os.getenv('DISPLAY_WIDTH', 1280))         # 고해상도 화면 타일용
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', 75))
+DISPLAY_QUALITY = int(os.getenv('DISPLAY_QUALITY', 82))
+DERIVATIVE_SUFFIXES = ('_thumb.webp', '.webp')
+
+def create_derivatives(result_path, image_id):
+    """결과 이미지에서 썸네일과 WebP 표시용 이미지를 만들어 갤러리 항목 필드로 반환
+
+    Pillow가 없거나 변환에 실패하면 빈 dict를 반환하고 원본만 사용한다.
+    """
+    if Image is None:
+        return {}
+    try:
+        derivatives = {}
+        with Image.open(result_path) as original:
+            original.load()
+            if original.mode not in ('RGB', 'RGBA'):
+                original = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+            for field, suffix, width, quality in (
+                ('thumbnail_image', '_thumb.webp', THUMBNAIL_WIDTH, THUMBNAIL_QUALITY),
+                ('display_image', '.webp', DISPLAY_WIDTH, DISPLAY_QUALITY),
+            ):
+                variant = original.copy()
+                # 가로 폭 기준으로 축소 (세로로 긴 이미지는 폭의 3배까지 허용)
+                variant.thumbnail((width, width * 3), Image.LANCZOS)
+                filename = f"{image_id}{suffix}"
+                variant_path = os.path.join(RESULT_FOLDER, filename)
+                variant.save(variant_path, 'WEBP', quality=quality, method=4)
+                content_index.register(variant_path)
+                storage_manager.track(os.path.getsize(variant_path))
+                derivatives[field] = f"/user_content/{filename}"
+        return derivatives
+    except Exception as e:
+        print(f"⚠️ 파생 이미지 생성 실패: {image_id} {e}")
+        return {}
+
+DERIVATIVE_WORKERS = int(os.getenv('DERIVATIVE_WORKERS', 2))   # 파생 이미지 인코딩 스레드 수
+derivative_executor = ThreadPoolExecutor(max_workers=DERIVATIVE_WORKERS, thread_name_prefix='derivatives')
+
+def build_derivatives(result_path, image_id):
+    """파생 이미지를 만들어 갤러리 항목에 반영 (생성 요청 밖, 백그라운드 실행)
+
+    그 사이 항목이 삭제됐으면 방금 만든 파일을 지운다. 반영 전까지 갤러리는 원본을 표시한다.
+    """
+    fields = create_derivatives(result_path, image_id)
+    if fields and not gallery_store.update_fields(image_id, fields):
+        for suffix in DERIVATIVE_SUFFIXES:
+            storage_manager.remove_file(os.path.join(RESULT_FOLDER, f"{image_id}{suffix}"))
+
+def result_files(item):
+    """갤러리 항목의 결과 원본과 파생 이미지 파일 경로 목록"""
+    filenames = [item['result_image'].replace('/user_content/', '')]
+    filenames += [f"{item['id']}{suffix}" for suffix in DERIVATIVE_SUFFIXES]
+    return [os.path.join(RESULT_FOLDER, name) for name in filenames]
+
+# --- 저장 공간 관리 (용량 한도 / 보관 기간) ---
+STORAGE_QUOTA_MB = int(os.getenv('STORAGE_QUOTA_MB', 0))              # 업로드+결과 폴더 용량 한도 (0이면 제한 없음)
+STORAGE_MAX_AGE_DAYS = float(os.getenv('STORAGE_MAX_AGE_DAYS', 0))    # 결과 보관 기간 (0이면 제한 없음)
+STORAGE_CHECK_INTERVAL = float(os.getenv('STORAGE_CHECK_INTERVAL', 300))
+STORAGE_EVICT_BATCH = 100
+
+class StorageManager:
+    """업로드/결과 폴더 용량을 추적하고 백그라운드 스레드에서 파일 삭제와 만료/용량 초과 정리를 수행
+
+    용량 한도를 넘거나 보관 기간이 지나면 가장 오래된 결과부터 갤러리 항목과 함께 제거한다.
+    """
+
+    def __init__(self, folders, quota_bytes, max_age_seconds, interval):
+        self.folders = folders
+        self.quota_bytes = quota_bytes
+        self.max_age_seconds = max_age_seconds
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._used = 0
+        self._scanned = False
+        self._tasks = queue.Queue()
+        self._thread = None
+        self.evicted = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='storage-manager', daemon=True)
+            self._thread.start()
+
+    def track(self, nbytes):
+        """새로 쓴 파일 크기를 사용량에 더함 (스캔 전에는 스캔 결과에 포함되므로 무시)"""
+        with self._lock:
+            if self._scanned:
+                self._used += nbytes
+
+    def remove_file(self, path):
+        """파일 삭제 후 사용량에서 뺌"""
+        content_index.unregister(path)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"파일 삭제 오류: {e}")
+            return
+        with self._lock:
+            if self._scanned:
+                self._used -= size
+
+    def delete_items_async(self, items):
+        """갤러리에서 제거된 항목들의 파일 삭제를 백그라운드로 넘김"""
+        if items:
+            self.start()
+            self._tasks.put(list(items))
+
+    def _delete_item_files(self, item):
+        for path in result_files(item):
+            self.remove_file(path)
+        # 첨부 이미지는 다른 항목이 참조하지 않을 때만 삭제
+        upload_store.release(upload_filenames(item.get('uploaded_images')))
+
+    def _scan(self):
+        # 시작 시 한 번 실제 사용량을 계산 (이후에는 증분 추적, 스캔 전의 증감은 스캔 값으로 대체)
+        total = 0
+        for folder in self.folders:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        with self._lock:
+            self._used = total
+            self._scanned = True
+
+    def _evict(self, image_ids, reason):
+        removed = gallery_store.remove_many(image_ids)
+        for item in removed:
+            self._delete_item_files(item)
+        self.evicted += len(removed)
+        if removed:
+            print(f"🧹 저장 공간 정리({reason}): {len(removed)}개 이미지 삭제, 사용량 {self.used_bytes() // (1024 * 1024)}MB")
+        return len(removed)
+
+    def enforce(self):
+        """보관 기간과 용량 한도를 넘긴 결과를 오래된 순으로 제거"""
+        if self.max_age_seconds:
+            cutoff = (get_korean_time() - timedelta(seconds=self.max_age_seconds)).isoformat()
+            while self._evict(gallery_store.oldest_ids(STORAGE_EVICT_BATCH, created_before=cutoff), '기간 만료'):
+                pass
+        if self.quota_bytes:
+            while self.used_bytes() > self.quota_bytes:
+                if not self._evict(gallery_store.oldest_ids(STORAGE_EVICT_BATCH), '용량 초과'):
+                    break
+
+    def used_bytes(self):
+        with self._lock:
+            return self._used
+
+    def stats(self):
+        return {
+            'used_mb': round(self.used_bytes() / (1024 * 1024), 1) if self._scanned else None,
+            'quota_mb': self.quota_bytes // (1024 * 1024) if self.quota_bytes else None,
+            'max_age_days': self.max_age_seconds / 86400 if self.max_age_seconds else None,
+            'pending_deletes': self._tasks.qsize(),
+            'evicted': self.evicted
+        }
+
+    def _run(self):
+        try:
+            self._scan()
+        except Exception as e:
+            print(f"❌ 저장 공간 스캔 실패: {e}")
+        next_check = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() >= next_check:
+                    self.enforce()
+                    next_check = time.monotonic() + self.interval
+                items = self._tasks.get(timeout=max(next_check - time.monotonic(), 0.1))
+            except queue.Empty:
+                continue
+            except Exception as e:
+                print(f"❌ 저장 공간 정리 실패: {e}")
+                next_check = time.monotonic() + self.interval
+                continue
+            for item in items:
+                try:
+                    self._delete_item_files(item)
+                except Exception as e:
+                    print(f"파일 삭제 오류: {e}")
+
+storage_manager = StorageManager(
+    (UPLOAD_FOLDER, RESULT_FOLDER),
+    STORAGE_QUOTA_MB * 1024 * 1024,
+    STORAGE_MAX_AGE_DAYS * 86400,
+    STORAGE_CHECK_INTERVAL
+)
+if STORAGE_QUOTA_MB or STORAGE_MAX_AGE_DAYS:
+    storage_manager.start()
+
 # 허용된 이미지 파일 확장자 및 검증 함수
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'tiff', 'svg'}
 MAX_FILE_SIZE = 15 * 1024 * 1024  # 15MB
@@ -80,9 +1296,13 @@ def validate_image_file(file):
         allowed_list = ', '.join(sorted(ALLOWED_EXTENSIONS))
         return False, f"지원하지 않는 파일 형식입니다. 허용 형식: {allowed_list}"
     
-    # MIME 타입 검사
+    # MIME 타입 검사 (클라이언트가 보낸 content_type과 실제 내용 모두 확인)
     if not file.content_type or not file.content_type.startswith('image/'):
         return False, f"이미지 파일이 아닙니다: {file.filename}"
+    head = file.read(1024)
+    file.seek(0)
+    if sniff_image_type(head) is None:
+        return False, f"이미지 파일이 아닙니다: {file.filename}"
     
     # 파일 크기 검사
     file.seek(0, 2)  # 파일 끝으로 이동
@@ -117,51 +1337,992 @@ def get_client_ip():
     else:
         return request.remote_addr
 
+# --- API 키 스케줄러 ---
+KEY_RPM_LIMIT = int(os.getenv('KEY_RPM_LIMIT', 0))                      # 키당 분당 요청 한도 (0이면 무제한)
+KEY_RATE_LIMIT_COOLDOWN = float(os.getenv('KEY_RATE_LIMIT_COOLDOWN', 60))  # 429에 Retry-After가 없을 때 쉬는 시간(초)
+KEY_ERROR_COOLDOWN = float(os.getenv('KEY_ERROR_COOLDOWN', 15))         # 연속 실패 시 기본 쉬는 시간(초)
+KEY_EWMA_ALPHA = 0.3                                                    # 지연/에러율 지수이동평균 가중치
+
+def mask_key(key):
+    """로그용 API 키 마스킹"""
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 8 else '****'
+
+def parse_retry_after(value):
+    """Retry-After 헤더(초 단위)를 float로 변환, 없거나 잘못되면 None"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class KeyState:
+    """API 키 하나의 건강 상태"""
+    __slots__ = ('key', 'latency', 'error_rate', 'cooldown_until', 'failures',
+                 'disabled', 'in_flight', 'recent', 'last_used')
+
+    def __init__(self, key):
+        self.key = key
+        self.latency = None          # 응답 지연 EWMA(초), 실패한 시도의 소요 시간도 포함
+        self.error_rate = 0.0        # 실패율 EWMA (0~1)
+        self.cooldown_until = 0.0    # 이 시각(monotonic)까지 사용 중지
+        self.failures = 0            # 연속 실패 횟수
+        self.disabled = False        # API_KEY_INVALID로 영구 제외
+        self.in_flight = 0
+        self.recent = deque()        # 최근 60초 요청 시각 (분당 한도 계산용)
+        self.last_used = 0.0
+
+class KeyScheduler:
+    """키별 상태(지연, 에러율, 429 쿨다운, 분당 한도)를 추적해 가장 건강한 키를 고르는 스레드 안전 스케줄러"""
+
+    def __init__(self, keys, rpm_limit=0):
+        self._lock = threading.Lock()
+        self._states = [KeyState(k) for k in dict.fromkeys(keys)]
+        self.rpm_limit = rpm_limit
+
+    def _available(self, state, now):
+        while state.recent and now - state.recent[0] >= 60:
+            state.recent.popleft()
+        if state.disabled or state.cooldown_until > now:
+            return False
+        if self.rpm_limit and len(state.recent) >= self.rpm_limit:
+            return False
+        return True
+
+    def _prior(self):
+        """측정값이 없는 키의 예상 지연: 측정된 키들의 중앙값 (하나도 없으면 0)"""
+        measured = sorted(s.latency for s in self._states if s.latency is not None)
+        return measured[len(measured) // 2] if measured else 0.0
+
+    @staticmethod
+    def _score(state, prior):
+        # 낮을수록 좋음: 측정값이 없는 키는 다른 키들의 중앙값으로 보고, 에러율과 동시 요청 수만큼 불이익
+        latency = state.latency if state.latency is not None else prior
+        return (latency * (1 + 4 * state.error_rate) * (1 + state.in_flight), state.last_used)
+
+    def acquire(self, exclude=()):
+        """exclude에 없는 사용 가능한 키 중 가장 건강한 키를 예약해 반환 (없으면 None)"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [s for s in self._states if s.key not in exclude and self._available(s, now)]
+            if not candidates:
+                return None
+            prior = self._prior()
+            state = min(candidates, key=lambda s: self._score(s, prior))
+            state.in_flight += 1
+            state.last_used = now
+            state.recent.append(now)
+            return state.key
+
+    def release(self, key, outcome, latency=None, retry_after=None):
+        """요청 결과를 반영: outcome은 ok / rate_limited / denied / invalid / client_error / error / cancelled"""
+        with self._lock:
+            state = next((s for s in self._states if s.key == key), None)
+            if state is None:
+                return
+            state.in_flight = max(state.in_flight - 1, 0)
+            if outcome == 'cancelled':
+                return
+            now = time.monotonic()
+            failed = outcome in ('rate_limited', 'denied', 'error')
+            state.error_rate += KEY_EWMA_ALPHA * ((1.0 if failed else 0.0) - state.error_rate)
+            # 타임아웃 등 실패한 시도에 걸린 시간도 지연에 반영해 느린 키가 다시 뽑히지 않게 함
+            if outcome in ('ok', 'error') and latency is not None:
+                state.latency = latency if state.latency is None else \
+                    state.latency + KEY_EWMA_ALPHA * (latency - state.latency)
+            if outcome == 'ok':
+                state.failures = 0
+            elif outcome == 'invalid':
+                state.disabled = True
+            elif outcome == 'rate_limited':
+                state.failures += 1
+                state.cooldown_until = now + (retry_after if retry_after is not None else KEY_RATE_LIMIT_COOLDOWN)
+            elif outcome == 'denied':
+                # 401/403은 키 자체의 문제(권한/결제/할당량)이므로 첫 실패부터 쉬게 함
+                state.failures += 1
+                state.cooldown_until = now + min(KEY_ERROR_COOLDOWN * 2 ** (state.failures - 1), 600)
+            elif outcome == 'error':
+                state.failures += 1
+                # 연속 실패가 쌓이면 지수적으로 쉬게 함 (최대 10분)
+                if state.failures >= 2:
+                    state.cooldown_until = now + min(KEY_ERROR_COOLDOWN * 2 ** (state.failures - 2), 600)
+
+    def stats(self):
+        """키별 상태 요약 (키는 마스킹)"""
+        with self._lock:
+            now = time.monotonic()
+            return [{
+                'key': mask_key(s.key),
+                'available': self._available(s, now),
+                'disabled': s.disabled,
+                'latency_ms': round(s.latency * 1000) if s.latency is not None else None,
+                'error_rate': round(s.error_rate, 3),
+                'cooldown_seconds': round(max(s.cooldown_until - now, 0), 1),
+                'in_flight': s.in_flight,
+                'requests_last_minute': len(s.recent)
+            } for s in self._states]
+
+key_scheduler = KeyScheduler(API_KEYS, KEY_RPM_LIMIT)
+
+# --- 업스트림 HTTP 세션 (커넥션 풀) ---
+UPSTREAM_POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 4))   # 호스트별 풀 캐시 개수
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', 16))          # 호스트당 유지할 keep-alive 연결 수
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 10))  # 연결 타임아웃(초)
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', 60))        # 응답 대기 타임아웃(초)
+UPSTREAM_TIMEOUT = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+
+def create_upstream_session():
+    """모든 업스트림 호출이 공유하는 keep-alive 세션 생성
+
+    urllib3 커넥션 풀은 스레드 안전하고, 쿠키 저장을 막아 세션 상태가 요청 간에 공유되지 않게 한다.
+    """
+    http = requests.Session()
+    http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(
+        pool_connections=UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+        max_retries=0  # 재시도는 키 로테이션 루프에서 처리
+    )
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+upstream_http = create_upstream_session()
+
+# --- 스트리밍 업스트림 본문 (첨부 base64 인코딩 / inlineData 디코딩) ---
+SPILL_FOLDER = os.path.join(RESULT_FOLDER, '.spill')   # 결과와 같은 파일시스템이어야 하드 링크 가능
+SPILL_MAX_AGE = float(os.getenv('SPILL_MAX_AGE', 600))  # 디코딩된 응답 이미지 보관 시간(초), 결과 캐시 TTL보다 짧아지지 않음
+os.makedirs(SPILL_FOLDER, exist_ok=True)
+
+class InlineFile:
+    """payload의 inlineData.data 자리에 두는 첨부 파일 참조 (전송할 때 파일에서 읽으며 인코딩)"""
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = path
+
+class StreamingBody:
+    """JSON 요청 본문: 첨부 파일 부분은 반복할 때마다 파일을 청크 단위로 읽어 base64로 내보냄
+
+    길이를 미리 계산해 두므로 requests가 Content-Length를 붙여 그대로 스트리밍하고,
+    재시도/헤지 시도마다 다시 반복할 수 있다.
+    """
+
+    def __init__(self, payload):
+        token = uuid.uuid4().hex
+        paths = []
+
+        def placeholder(obj):
+            if isinstance(obj, InlineFile):
+                paths.append(obj.path)
+                return f"{token}:{len(paths) - 1}"
+            raise TypeError(f"JSON으로 직렬화할 수 없는 값: {type(obj).__name__}")
+
+        pieces = re.split(f'"{token}:(\\d+)"', json.dumps(payload, default=placeholder))
+        self._segments = []
+        self._length = 0
+        for i, piece in enumerate(pieces):
+            if i % 2 == 0:
+                segment = piece.encode('utf-8')
+                self._length += len(segment)
+            else:
+                segment = paths[int(piece)]
+                # 따옴표 2개 + base64 길이
+                self._length += 2 + 4 * ((os.path.getsize(segment) + 2) // 3)
+            self._segments.append(segment)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for segment in self._segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            yield b'"'
+            with open(segment, 'rb') as f:
+                while True:
+                    chunk = f.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield base64.b64encode(chunk)
+            yield b'"'
+
+class InlineDataDecoder:
+    """JSON 응답을 청크 단위로 받으며 inlineData.data 문자열은 base64 디코딩해 스필 파일에 바로 기록
+
+    나머지 부분(텍스트 등 작은 값)만 메모리에 모아 마지막에 json.loads 한다.
+    디코딩된 inlineData는 {"mimeType": ..., "file": 스필 파일 경로}로 바뀐다.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.token = uuid.uuid4().hex
+        self.paths = []
+        self._text = bytearray()
+        self._stack = []          # 현재 중첩된 객체/배열의 키
+        self._key = None
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()
+        self._last_string = None
+        self._await_data = False  # inlineData의 "data": 다음 문자열 시작을 기다리는 중
+        self._spill = None
+        self._b64_rest = b''
+
+    def feed(self, chunk):
+        i, n = 0, len(chunk)
+        while i < n:
+            if self._spill is not None:
+                # base64 문자열 안: 닫는 따옴표까지 한 번에 디코딩
+                end = chunk.find(b'"', i)
+                self._decode(chunk[i:n if end < 0 else end])
+                if end < 0:
+                    return
+                self._close_spill()
+                i = end + 1
+                continue
+
+            byte = chunk[i]
+            i += 1
+            if self._in_string:
+                self._text.append(byte)
+                if self._escape:
+                    self._escape = False
+                elif byte == 0x5c:      # \
+                    self._escape = True
+                elif byte == 0x22:      # "
+                    self._in_string = False
+                    self._last_string = bytes(self._string)
+                elif len(self._string) <= 32:
+                    self._string.append(byte)
+                continue
+
+            if self._await_data:
+                if byte in b' \t\r\n':
+                    self._text.append(byte)
+                    continue
+                self._await_data = False
+                if byte == 0x22:
+                    self._open_spill()
+                    continue
+
+            self._text.append(byte)
+            if byte == 0x22:
+                self._in_string = True
+                self._string = bytearray()
+            elif byte == 0x3a:          # :
+                self._key = self._last_string
+                self._await_data = self._key == b'data' and self._stack[-1:] == [b'inlineData']
+            elif byte in b'{[':
+                self._stack.append(self._key)
+                self._key = None
+            elif byte in b'}]':
+                if self._stack:
+                    self._stack.pop()
+
+    def _open_spill(self):
+        path = os.path.join(self.folder, f"{uuid.uuid4().hex}.bin")
+        self._spill = open(path, 'wb')
+        self.paths.append(path)
+        self._text += f'"{self.token}:{len(self.paths) - 1}'.encode('ascii')
+
+    def _decode(self, data):
+        data = self._b64_rest + data
+        held = b''
+        if b'\\' in data:
+            # base64에는 JSON 이스케이프(\/ 등)가 드물지만 처리, 청크 끝에 걸린 \는 다음 청크와 합침
+            if data.endswith(b'\\'):
+                data, held = data[:-1], b'\\'
+            data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        usable = len(data) - len(data) % 4
+        if usable:
+            self._spill.write(binascii.a2b_base64(data[:usable]))
+        self._b64_rest = data[usable:] + held
+
+    def _close_spill(self):
+        if self._b64_rest:
+            self._spill.write(binascii.a2b_base64(self._b64_rest))
+            self._b64_rest = b''
+        self._spill.close()
+        self._spill = None
+        self._text += b'"'
+
+    def finish(self):
+        if self._spill is not None:
+            raise ValueError('응답이 inlineData 도중에 끊겼습니다.')
+        data = json.loads(bytes(self._text))
+        self._replace(data)
+        return data
+
+    def _replace(self, node):
+        if isinstance(node, dict):
+            inline = node.get('inlineData')
+            if isinstance(inline, dict) and isinstance(inline.get('data'), str) \
+                    and inline['data'].startswith(f"{self.token}:"):
+                inline['file'] = self.paths[int(inline.pop('data').split(':', 1)[1])]
+            for value in node.values():
+                self._replace(value)
+        elif isinstance(node, list):
+            for value in node:
+                self._replace(value)
+
+    def discard(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+_spill_sweep = {'last': 0.0}
+_spill_sweep_lock = threading.Lock()
+
+def sweep_spill_files():
+    """보관 시간이 지난 스필 파일 삭제 (최대 1분에 한 번)
+
+    스필 파일은 병합된 요청과 결과 캐시가 같은 응답을 재사용하는 동안 남아 있어야 하므로
+    결과 캐시 TTL보다 먼저 지우지 않는다. 헤지에서 진 응답의 파일도 여기서 정리된다.
+    """
+    now = time.time()
+    with _spill_sweep_lock:
+        if now - _spill_sweep['last'] < 60:
+            return
+        _spill_sweep['last'] = now
+    cutoff = now - max(SPILL_MAX_AGE, RESULT_CACHE_TTL + 60)
+    with os.scandir(SPILL_FOLDER) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+class UpstreamCancelled(Exception):
+    """다른 시도가 먼저 성공해 중단된 업스트림 요청"""
+
+def read_upstream_json(response, cancel=None):
+    """성공 응답 본문을 스트리밍으로 읽어 파싱 (inlineData는 스필 파일로)
+
+    cancel(threading.Event)이 설정되면 남은 본문을 받지 않고 중단한다.
+    """
+    sweep_spill_files()
+    decoder = InlineDataDecoder(SPILL_FOLDER)
+    try:
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            if cancel is not None and cancel.is_set():
+                raise UpstreamCancelled('다른 시도가 먼저 완료됨')
+            decoder.feed(chunk)
+        return decoder.finish()
+    except Exception:
+        decoder.discard()
+        raise
+
+def save_inline_image(inline, path):
+    """inlineData를 결과 파일로 저장하고 크기 반환 (스필 파일은 하드 링크, 안 되면 복사)"""
+    spill_path = inline.get('file')
+    if spill_path is None:
+        with open(path, 'wb') as f:
+            f.write(base64.b64decode(inline['data']))
+    else:
+        try:
+            os.link(spill_path, path)
+        except OSError:
+            shutil.copyfile(spill_path, path)
+    return os.path.getsize(path)
+
+# --- 헤지 요청 (꼬리 지연 완화) ---
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))        # 이 백분위 지연을 넘기면 헤지
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 2))           # 헤지 지연 하한(초)
+HEDGE_MAX_DELAY = float(os.getenv('HEDGE_MAX_DELAY', 30))          # 헤지 지연 상한(초), 표본이 적을 때 사용
+HEDGE_MAX_RATIO = float(os.getenv('HEDGE_MAX_RATIO', 0.1))         # 전체 요청 대비 추가 요청 비율 상한
+HEDGE_MIN_SAMPLES = 20
+
+class HedgePolicy:
+    """최근 성공 지연의 백분위로 헤지 지연을 정하고, 추가 부하를 요청 비율로 제한"""
+
+    def __init__(self, percentile, min_delay, max_delay, max_ratio):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_ratio = max_ratio
+        self._budget = 1.0   # 요청마다 max_ratio만큼 쌓이고 헤지마다 1씩 소모
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+            self._budget = min(self._budget + self.max_ratio, 10.0)
+
+    def delay(self):
+        """현재 헤지 지연(초)"""
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return self.max_delay
+            ordered = sorted(self._latencies)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return min(max(ordered[index], self.min_delay), self.max_delay)
+
+    def try_fire(self):
+        """예산이 남아 있으면 헤지 1회를 소모하고 True"""
+        with self._lock:
+            if self._budget < 1.0:
+                return False
+            self._budget -= 1.0
+            self.fired += 1
+            return True
+
+    def refund(self):
+        """보낼 키가 없어 헤지를 보내지 못했을 때 소모한 예산과 집계를 되돌림"""
+        with self._lock:
+            self._budget = min(self._budget + 1.0, 10.0)
+            self.fired -= 1
+
+    def record_win(self):
+        with self._lock:
+            self.won += 1
+
+    def stats(self):
+        return {
+            'enabled': HEDGE_ENABLED,
+            'delay_seconds': round(self.delay(), 2),
+            'requests': self.requests,
+            'hedges_fired': self.fired,
+            'hedges_won': self.won
+        }
+
+hedge_policy = HedgePolicy(HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY, HEDGE_MAX_RATIO)
+hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv('HEDGE_POOL_SIZE', 16)), thread_name_prefix='upstream')
+
 def make_headers():
     headers = {"Content-Type": "application/json"}
     if API_BEARER_TOKEN:
         headers["Authorization"] = f"Bearer {API_BEARER_TOKEN}"
     return headers
 
-def send_request_sync(payload):
-    global API_KEYS, API_KEY_CYCLE
+def request_with_key(key, body, headers, timer=None, cancel=None):
+    """키 하나로 업스트림 요청 1회 수행, 결과를 스케줄러에 반영 (실패 시 예외)
+
+    body는 미리 만든 StreamingBody (재시도/헤지마다 다시 직렬화하지 않음)
+    cancel(threading.Event)이 설정되면 응답을 더 받지 않고 연결을 닫는다 (헤지에서 진 시도).
+    """
+    url = f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL}:generateContent?key={key}"
+    outcome = 'error'
+    retry_after = None
+    status = 'error'
+    started = time.monotonic()
+    response = None
+    try:
+        with timed_phase(timer, 'upstream_wait'):
+            response = upstream_http.post(url, headers=headers, data=body, timeout=UPSTREAM_TIMEOUT, stream=True)
+        status = response.status_code
+        if cancel is not None and cancel.is_set():
+            raise UpstreamCancelled('다른 시도가 먼저 완료됨')
+        
+        if response.status_code == 429:
+            outcome = 'rate_limited'
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            raise RuntimeError(f"API 키 한도 초과: {mask_key(key)}")
+
+        if response.status_code in (401, 403):
+            outcome = 'denied'
+            raise RuntimeError(f"API 키 권한 거부({response.status_code}): {mask_key(key)}")
+
+        if 400 <= response.status_code < 500:
+            # 요청 자체의 문제는 키 상태에 반영하지 않음
+            outcome = 'client_error'
+
+        if response.status_code == 400:
+            data = response.json()
+            if "error" in data:
+                details = data["error"].get("details", [])
+                if any(d.get("reason") == "API_KEY_INVALID" for d in details):
+                    outcome = 'invalid'
+                    raise RuntimeError(f"Invalid API key 제외: {mask_key(key)}")
+
+        response.raise_for_status()
+        with timed_phase(timer, 'response_parse'):
+            data = read_upstream_json(response, cancel)
+        outcome = 'ok'
+        hedge_policy.record_latency(time.monotonic() - started)
+        return data
+    finally:
+        if response is not None:
+            response.close()
+        if outcome != 'ok' and cancel is not None and cancel.is_set():
+            # 중단한 시도는 키 상태에 반영하지 않음
+            outcome = 'cancelled'
+            status = 'cancelled'
+        elapsed = time.monotonic() - started
+        key_scheduler.release(key, outcome, elapsed, retry_after)
+        UPSTREAM_SECONDS.observe(elapsed, key=key_label(key), status=status)
+        UPSTREAM_REQUESTS.inc(key=key_label(key), status=status)
+
+def send_with_hedging(body, headers, timer=None):
+    """첫 시도가 지연되면 다른 키로 두 번째 시도를 병렬로 보내고 먼저 성공한 응답을 사용"""
+    tried = set()
+    pending = {}        # future -> (헤지 시도 여부, 중단 이벤트)
+    hedged = False
+    hedge_policy.record_request()
+    while True:
+        if not pending:
+            key = key_scheduler.acquire(exclude=tried)
+            if key is None:
+                break
+            tried.add(key)
+            cancel = threading.Event()
+            pending[hedge_executor.submit(request_with_key, key, body, headers, timer, cancel)] = (False, cancel)
+        
+        # 단일 시도만 진행 중이고 아직 헤지하지 않았다면 헤지 지연 시간까지만 대기
+        timeout = hedge_policy.delay() if not hedged and len(pending) == 1 else None
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        
+        if not done:
+            hedged = True
+            if hedge_policy.try_fire():
+                key = key_scheduler.acquire(exclude=tried)
+                if key is None:
+                    hedge_policy.refund()
+                else:
+                    tried.add(key)
+                    cancel = threading.Event()
+                    pending[hedge_executor.submit(request_with_key, key, body, headers, timer, cancel)] = (True, cancel)
+                    print(f"🔀 헤지 요청 발송: {mask_key(key)} (지연 {timeout:.1f}s 초과)")
+            continue
+        
+        for future in done:
+            is_hedge, _ = pending.pop(future)
+            try:
+                data = future.result()
+            except Exception as e:
+                print(f"❌ 업스트림 요청 실패: {e}")
+                continue
+            if is_hedge:
+                hedge_policy.record_win()
+            # 진 시도는 응답을 더 받지 않고 연결을 닫게 함
+            for _, cancel in pending.values():
+                cancel.set()
+            return data
+    raise RuntimeError("🚨 모든 API KEY 실패")
+
+def send_request_sync(payload, timer=None):
     headers = make_headers()
+    with timed_phase(timer, 'serialize'):
+        body = StreamingBody(payload)
 
     if API_KEYS:
-        keys_to_try = list(API_KEYS)
-        for _ in range(len(keys_to_try)):
-            key = next(API_KEY_CYCLE)
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent?key={key}"
+        if HEDGE_ENABLED:
+            return send_with_hedging(body, headers, timer)
+        
+        tried = set()
+        while True:
+            # 이번 요청에서 아직 시도하지 않은 키 중 가장 건강한 키 선택
+            key = key_scheduler.acquire(exclude=tried)
+            if key is None:
+                break
+            tried.add(key)
             try:
-                response = requests.post(url, headers=headers, json=payload, timeout=60)
-                
-                if response.status_code == 400:
-                    data = response.json()
-                    if "error" in data:
-                        details = data["error"].get("details", [])
-                        if any(d.get("reason") == "API_KEY_INVALID" for d in details):
-                            print(f"⚠️ Invalid API key 제외: {key}")
-                            API_KEYS = [k for k in API_KEYS if k != key]
-                            API_KEY_CYCLE = itertools.cycle(API_KEYS) if API_KEYS else None
-                            continue
-
-                response.raise_for_status()
-                return response.json()
-                
+                return request_with_key(key, body, headers, timer)
             except Exception as e:
-                print(f"❌ {url} 요청 실패: {e}")
+                print(f"❌ 업스트림 요청 실패: {e}")
                 continue
         raise RuntimeError("🚨 모든 API KEY 실패")
     else:
         if not API_URL_ENV:
             raise RuntimeError("🚨 API_KEY도 API_URL도 없음. 환경변수 확인하세요.")
+        status = 'error'
+        started = time.monotonic()
+        response = None
         try:
-            response = requests.post(API_URL_ENV, headers=headers, json=payload, timeout=60)
+            with timed_phase(timer, 'upstream_wait'):
+                response = upstream_http.post(API_URL_ENV, headers=headers, data=body, timeout=UPSTREAM_TIMEOUT, stream=True)
+            status = response.status_code
             response.raise_for_status()
-            return response.json()
+            with timed_phase(timer, 'response_parse'):
+                return read_upstream_json(response)
         except Exception as e:
             print(f"❌ {API_URL_ENV} 요청 실패: {e}")
             raise
+        finally:
+            if response is not None:
+                response.close()
+            UPSTREAM_SECONDS.observe(time.monotonic() - started, key='api_url', status=status)
+            UPSTREAM_REQUESTS.inc(key='api_url', status=status)
+
+# --- 동일 요청 병합 / 결과 캐시 ---
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', 0))      # 동일 요청 결과 재사용 시간(초), 0이면 캐시 끔
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 32))     # 캐시할 응답 수 (응답마다 이미지 base64 포함)
+
+def generation_key(parts, uploaded_images, payload, variant=None):
+    """프롬프트, 첨부 이미지(내용 해시), 생성 설정으로 동일 요청 판별 키 생성
+
+    배치의 변형(variant)은 번호별로 다른 키가 되어 서로 병합되지 않는다.
+    """
+    identity = {
+        'text': [part['text'] for part in parts if 'text' in part],
+        'images': upload_filenames(uploaded_images),
+        'generationConfig': payload.get('generationConfig'),
+        'safetySettings': payload.get('safetySettings')
+    }
+    if variant is not None:
+        identity['variant'] = variant
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class UpstreamCoalescer:
+    """진행 중인 동일 요청은 업스트림 호출 하나를 공유하고(single-flight), 선택적으로 최근 결과를 TTL 캐시"""
+
+    def __init__(self, cache_ttl, cache_size):
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._cache = OrderedDict()  # key -> (만료 시각, 응답)
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _cached(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return result
+
+    def call(self, key, func):
+        """key가 같은 호출은 func를 한 번만 실행해 결과를 공유"""
+        with self._lock:
+            result = self._cached(key) if self.cache_ttl > 0 else None
+            if result is not None:
+                self.cache_hits += 1
+                return result
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.error is None and self.cache_ttl > 0:
+                    self._cache[key] = (time.monotonic() + self.cache_ttl, flight.result)
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cache_enabled': self.cache_ttl > 0,
+                'cache_entries': len(self._cache),
+                'cache_hits': self.cache_hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+                'in_flight': len(self._inflight)
+            }
+
+upstream_coalescer = UpstreamCoalescer(RESULT_CACHE_TTL, RESULT_CACHE_SIZE)
+
+# --- 비동기 생성 작업 ---
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', 4))          # 동시에 실행할 업스트림 호출 수
+GENERATION_QUEUE_SIZE = int(os.getenv('GENERATION_QUEUE_SIZE', 32))   # 대기열 최대 길이
+GENERATION_JOB_TTL = int(os.getenv('GENERATION_JOB_TTL', 600))        # 완료된 작업 보관 시간(초)
+JOB_MAX_WAIT = 30       # 롱폴링 최대 대기 시간(초)
+JOB_RETRY_AFTER = 5     # 대기열이 가득 찼을 때 안내할 재시도 간격(초)
+
+class JobQueueFull(Exception):
+    """생성 대기열이 가득 참"""
+
+class GenerationJobQueue:
+    """고정 크기 워커 풀과 제한된 대기열로 생성 작업을 실행"""
+
+    def __init__(self, workers, queue_size, job_ttl):
+        self.workers = workers
+        self.job_ttl = job_ttl
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._last_sweep = time.monotonic()
+
+    def _ensure_workers(self):
+        # 워커 스레드는 첫 작업 등록 시 시작
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f'generation-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, func, **kwargs):
+        """작업을 대기열에 넣고 작업 스냅샷 반환 (가득 차면 JobQueueFull)"""
+        job = {'id': uuid.uuid4().hex, 'status': 'queued', 'result': None,
+               'created': time.monotonic(), 'finished': None, 'timer': kwargs.get('timer')}
+        with self._cond:
+            self._ensure_workers()
+            self._sweep()
+            try:
+                self._queue.put_nowait((job['id'], func, kwargs))
+            except queue.Full:
+                raise JobQueueFull()
+            self._jobs[job['id']] = job
+            return dict(job)
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout):
+        """작업이 끝나거나 timeout이 지날 때까지 대기 후 스냅샷 반환"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._jobs.get(job_id, {}).get('status') not in ('queued', 'running'),
+                timeout=timeout)
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job['status'] == 'running')
+        return {'queued': self._queue.qsize(), 'running': running, 'workers': self.workers}
+
+    def _sweep(self):
+        # TTL이 지난 완료 작업 정리 (호출자가 락을 보유)
+        now = time.monotonic()
+        if now - self._last_sweep < 30:
+            return
+        self._last_sweep = now
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished'] is not None and now - job['finished'] > self.job_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _set(self, job_id, **fields):
+        with self._cond:
+            self._jobs[job_id].update(fields)
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            job_id, func, kwargs = self._queue.get()
+            self._set(job_id, status='running')
+            try:
+                result, status_code = func(**kwargs)
+            except Exception as e:
+                print(f"❌ 생성 작업 실패: {job_id} {e}")
+                result, status_code = {'error': f'오류 발생: {str(e)}'}, 500
+            self._set(job_id, status='done' if status_code == 200 else 'failed',
+                      result=result, finished=time.monotonic())
+            self._queue.task_done()
+
+generation_jobs = GenerationJobQueue(GENERATION_WORKERS, GENERATION_QUEUE_SIZE, GENERATION_JOB_TTL)
+
+# --- 요청 수용 제어 (IP별 속도/동시 생성 제한, 대역 차단, 전역 대기 한도) ---
+# IP별 제한은 기본으로 꺼 둠: IP는 X-Forwarded-For를 그대로 믿으므로 신뢰할 수 있는 프록시 뒤에서만 켤 것
+GENERATE_RATE_PER_MIN = float(os.getenv('GENERATE_RATE_PER_MIN', 0))        # IP별 분당 생성 요청 수 (토큰 보충 속도), 0이면 제한 없음
+GENERATE_BURST = int(os.getenv('GENERATE_BURST', 0))                        # IP별 순간 허용 요청 수 (버킷 크기), 0이면 분당 요청 수와 같게
+GENERATE_MAX_PER_IP = int(os.getenv('GENERATE_MAX_PER_IP', 0))              # IP별 동시 진행 생성 수, 0이면 제한 없음
+GENERATE_MAX_PENDING = int(os.getenv('GENERATE_MAX_PENDING', GENERATION_WORKERS + GENERATION_QUEUE_SIZE))  # 전체 진행+대기 생성 수
+BANNED_CIDRS = [c.strip() for c in os.getenv('BANNED_CIDRS', '').split(',') if c.strip()]  # 예: 203.0.113.0/24,2001:db8::/32
+GENERATION_ENDPOINTS = {'generate_image', 'submit_generation_job', 'generate_batch'}
+ADMISSION_REJECTED = metrics.register(Counter(
+    'admission_rejected_total', '수용 제어로 거절된 생성 요청 수', ('reason',)))
+
+class BanList:
+    """개별 IP와 CIDR 대역 차단 목록
+
+    대역은 프리픽스 길이별 네트워크 주소 집합으로 보관해, 조회 비용이 차단 항목 수가 아니라
+    사용 중인 프리픽스 길이 종류 수(IPv4 최대 33, IPv6 최대 129)에만 비례한다.
+    """
+
+    def __init__(self, entries=()):
+        self._lock = threading.Lock()
+        self._entries = set()
+        self._raw = set()           # 주소로 해석되지 않는 값 (정확히 일치만 비교)
+        self._networks = {}         # (버전, 프리픽스 길이) -> 네트워크 주소 정수 집합
+        self.update(entries)
+
+    def update(self, entries):
+        with self._lock:
+            for entry in entries:
+                self._add(entry)
+
+    def _add(self, entry):
+        self._entries.add(entry)
+        try:
+            network = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            self._raw.add(entry)
+            return
+        key = (network.version, network.prefixlen)
+        # 딕셔너리는 교체 방식으로 갱신 (조회 쪽은 락 없이 읽음)
+        networks = dict(self._networks)
+        networks[key] = networks.get(key, frozenset()) | {int(network.network_address)}
+        self._networks = networks
+
+    def __contains__(self, ip):
+        if ip in self._raw:
+            return True
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        value = int(address)
+        bits = address.max_prefixlen
+        for (version, prefixlen), addresses in self._networks.items():
+            if version == address.version and (value >> (bits - prefixlen)) << (bits - prefixlen) in addresses:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._entries)
+
+banned_ips = BanList(gallery_store.banned_ips() | set(BANNED_CIDRS))  # 요청마다 확인하므로 메모리에 유지
+
+class AdmissionTicket:
+    """수용된 생성 요청 하나 (생성이 끝나면 release, 여러 번 호출해도 한 번만 반영)
+
+    weight는 전체 대기 한도에서 차지하는 생성 수 (배치 요청은 항목 수만큼)
+    """
+    __slots__ = ('controller', 'ip', 'weight', '_released')
+
+    def __init__(self, controller, ip):
+        self.controller = controller
+        self.ip = ip
+        self.weight = 1
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(self.ip, self.weight)
+
+class AdmissionController:
+    """생성 요청을 본문을 읽기 전에 수용하거나 바로 429로 거절
+
+    - IP별 토큰 버킷 (분당 rate, 최대 burst)
+    - IP별 동시 진행 생성 수 상한
+    - 전체 진행+대기 생성 수 상한 (업스트림 대기 뒤에 실패시키지 않고 즉시 거절)
+    """
+
+    def __init__(self, rate_per_min, burst, max_per_ip, max_pending):
+        self.rate = rate_per_min / 60
+        self.burst = burst or max(math.ceil(rate_per_min), 1)
+        self.max_per_ip = max_per_ip
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._buckets = {}      # ip -> [토큰 수, 마지막 갱신 시각]
+        self._active = {}       # ip -> 진행 중인 생성 수
+        self._pending = 0
+
+    def admit(self, ip):
+        """(AdmissionTicket, None) 또는 (None, (거절 사유, Retry-After 초)) 반환"""
+        now = time.monotonic()
+        with self._lock:
+            if self.max_pending and self._pending >= self.max_pending:
+                return None, ('queue_full', JOB_RETRY_AFTER)
+            if self.max_per_ip and self._active.get(ip, 0) >= self.max_per_ip:
+                return None, ('concurrency', JOB_RETRY_AFTER)
+            if self.rate > 0:
+                tokens, updated = self._buckets.get(ip, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens < 1:
+                    self._buckets[ip] = [tokens, now]
+                    return None, ('rate_limited', math.ceil((1 - tokens) / self.rate))
+                self._buckets[ip] = [tokens - 1, now]
+                if len(self._buckets) > 10000:
+                    self._prune(now)
+            self._active[ip] = self._active.get(ip, 0) + 1
+            self._pending += 1
+        return AdmissionTicket(self, ip), None
+
+    def extend(self, ticket, count):
+        """이미 수용된 요청에 생성 count건을 추가 배정 (배치 요청)
+
+        반환값: None 또는 (거절 사유, Retry-After 초)
+        """
+        if count <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if self.max_pending and self._pending + count > self.max_pending:
+                return 'queue_full', JOB_RETRY_AFTER
+            if self.rate > 0:
+                tokens, updated = self._buckets.get(ticket.ip, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens < count:
+                    self._buckets[ticket.ip] = [tokens, now]
+                    return 'rate_limited', math.ceil((count - tokens) / self.rate)
+                self._buckets[ticket.ip] = [tokens - count, now]
+            self._pending += count
+            ticket.weight += count
+        return None
+
+    def _release(self, ip, weight=1):
+        with self._lock:
+            self._pending -= weight
+            remaining = self._active.get(ip, 0) - 1
+            if remaining > 0:
+                self._active[ip] = remaining
+            else:
+                self._active.pop(ip, None)
+
+    def _prune(self, now):
+        # 이미 가득 찼을 버킷은 지워도 동작이 같음 (호출자가 락을 보유)
+        refill = self.burst / self.rate
+        for ip in [ip for ip, (_, updated) in self._buckets.items() if now - updated >= refill]:
+            del self._buckets[ip]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'active_ips': len(self._active),
+                'tracked_ips': len(self._buckets)
+            }
+
+admission_control = AdmissionController(GENERATE_RATE_PER_MIN, GENERATE_BURST, GENERATE_MAX_PER_IP, GENERATE_MAX_PENDING)
+
+# --- 배치 / 변형 생성 ---
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 4))          # 배치 하나의 최대 생성 수 (프롬프트 수 × 변형 수, IP별 버킷 크기도 넘을 수 없음)
+BATCH_PARALLELISM = int(os.getenv('BATCH_PARALLELISM', 4))      # 배치 하나에서 동시에 보내는 업스트림 요청 수
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 16))             # 모든 배치가 공유하는 실행 스레드 수
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -200,13 +2361,69 @@ def logout():
     session.pop('authenticated', None)
     return redirect(url_for('login'))
 
+@app.before_request
+def start_request_timer():
+    """요청 처리 시간 측정 시작"""
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    """라우트별 처리 시간과 요청/응답 크기 기록"""
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, route=route,
+                                     method=request.method, status=response.status_code)
+        if request.content_length:
+            HTTP_REQUEST_BYTES.observe(request.content_length, route=route)
+        if response.content_length is not None:
+            HTTP_RESPONSE_BYTES.observe(response.content_length, route=route)
+        if SERVER_TIMING_ENABLED:
+            timer = getattr(g, 'timer', None)
+            if timer is not None:
+                response.headers['Server-Timing'] = timer.header()
+            else:
+                response.headers['Server-Timing'] = f"total;dur={(time.monotonic() - started) * 1000:.1f}"
+    return response
+
 @app.before_request
 def check_banned_ip():
-    """밴된 IP 체크"""
+    """밴된 IP / 대역 체크"""
     client_ip = get_client_ip()
     if client_ip and client_ip in banned_ips:
         return jsonify({'error': '접근이 차단되었습니다.'}), 403
 
+@app.before_request
+def admit_generation():
+    """생성 요청은 업로드 본문을 읽기 전에 수용 여부 결정 (거절은 429 + Retry-After)"""
+    if request.endpoint not in GENERATION_ENDPOINTS or not session.get('authenticated'):
+        return None
+    ticket, rejection = admission_control.admit(get_client_ip())
+    if ticket is not None:
+        g.admission = ticket
+        return None
+
+    return admission_rejected(*rejection)
+
+def admission_rejected(reason, retry_after):
+    """수용 제어 거절 응답 (429 + Retry-After)"""
+    ADMISSION_REJECTED.inc(reason=reason)
+    messages = {
+        'queue_full': '생성 대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요.',
+        'concurrency': '이미 진행 중인 생성 요청이 있습니다. 완료 후 다시 시도해주세요.',
+        'rate_limited': '요청이 너무 많습니다. 잠시 후 다시 시도해주세요.'
+    }
+    response = jsonify({'error': messages[reason]})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+@app.teardown_request
+def release_admission(error=None):
+    """동기 생성이 끝나면 수용 슬롯 반환 (비동기 작업으로 넘긴 슬롯은 작업 종료 시 반환)"""
+    ticket = g.pop('admission', None)
+    if ticket is not None:
+        ticket.release()
+
 # 모든 기존 라우트에 인증 적용
 @app.route('/')
 @require_auth
@@ -218,41 +2435,179 @@ def index():
 def gallery():
     return render_template('gallery.html')
 
+def annotate_likes(items, client_ip):
+    """페이지 항목에 현재 사용자의 좋아요 여부와 아직 저장소에 반영되지 않은 좋아요 수를 반영"""
+    # 현재 사용자 IP의 좋아요 기록 확인 (이번 페이지 항목만 조회)
+    user_likes = gallery_store.liked_ids(client_ip, [item['id'] for item in items])
+    user_likes |= like_counter.pending_ids(client_ip)
+    for item in items:
+        item['likes'] += like_counter.pending_delta(item['id'])
+        item['user_liked'] = item['id'] in user_likes
+
 # 갤러리 API (무한 스크롤용)
 @app.route('/api/gallery')
 @require_auth
 def api_gallery():
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 15))
     sort_by = request.args.get('sort', 'newest')
+    if sort_by not in GALLERY_SORTS:
+        sort_by = 'newest'
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 15)), 1), MAX_PER_PAGE)
+    except ValueError:
+        return jsonify({'error': '잘못된 페이지 값입니다.'}), 400
     
-    # 정렬
-    sorted_gallery = image_gallery.copy()
-    
-    if sort_by == 'oldest':
-        sorted_gallery.sort(key=lambda x: x['created_at'])
-    elif sort_by == 'likes':
-        sorted_gallery.sort(key=lambda x: x['likes'], reverse=True)
-    else:  # newest (default)
-        sorted_gallery.sort(key=lambda x: x['created_at'], reverse=True)
+    # since가 있으면 해당 피드 커서 이후의 변경분만 응답
+    since = request.args.get('since')
+    if since is not None:
+        return gallery_delta(since)
     
-    # 페이지네이션
-    start_index = (page - 1) * per_page
-    end_index = start_index + per_page
-    page_images = sorted_gallery[start_index:end_index]
+    # 페이지를 읽기 전에 피드 커서를 잡아 두어 그 사이의 변경도 놓치지 않게 함 (중복은 id로 걸러짐)
+    feed_cursor = gallery_feed.cursor()
     
-    # 현재 사용자 IP의 좋아요 기록 확인
-    client_ip = get_client_ip()
-    user_likes = like_records.get(client_ip, set())
+    # 커서가 있으면 커서 기반, 없으면 기존 page 기반 페이지네이션
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            cursor_key = decode_cursor(cursor, sort_by) if cursor else None
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+        page_images, next_cursor = gallery_store.page_after(sort_by, cursor_key, per_page)
+        has_more = next_cursor is not None
+    else:
+        page_images, has_more = gallery_store.page(sort_by, (page - 1) * per_page, per_page)
+        next_cursor = None
+        if has_more and page_images:
+            next_cursor = gallery_store.cursor_for(sort_by, page_images[-1])
     
-    # 각 이미지에 현재 사용자가 좋아요했는지 표시
-    for item in page_images:
-        item['user_liked'] = item['id'] in user_likes
+    annotate_likes(page_images, get_client_ip())
     
     return jsonify({
         'images': page_images,
-        'has_more': end_index < len(sorted_gallery),
-        'total': len(sorted_gallery),
+        'has_more': has_more,
+        'next_cursor': next_cursor,
+        'total': len(gallery_store),
+        'page': page,
+        'per_page': per_page,
+        'since_cursor': feed_cursor
+    })
+
+def gallery_delta(since):
+    """피드 커서 이후 추가/삭제/좋아요 수 변경분 (이어 줄 수 없으면 reset)"""
+    try:
+        seq = gallery_feed.decode(since)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    delta = gallery_feed.delta(seq) if seq is not None else None
+    if delta is None:
+        return jsonify({'reset': True, 'since_cursor': gallery_feed.cursor()})
+    annotate_likes(delta['added'], get_client_ip())
+    # /api/gallery와 같게 아직 반영되지 않은 좋아요도 포함
+    likes = {image_id: count + like_counter.pending_delta(image_id) for image_id, count in delta['likes'].items()}
+    return jsonify({
+        'reset': False,
+        'added': delta['added'],
+        'deleted': delta['deleted'],
+        'likes': likes,
+        'since_cursor': delta['cursor']
+    })
+
+gallery_streams = threading.BoundedSemaphore(GALLERY_STREAM_MAX)
+
+@app.route('/api/gallery/stream')
+@require_auth
+def api_gallery_stream():
+    """갤러리 변경 이벤트 SSE 스트림 (event: added / deleted / likes / reset)
+
+    since 파라미터나 재연결 시 브라우저가 보내는 Last-Event-ID부터 이어서 전송하고,
+    GALLERY_STREAM_MAX_AGE가 지나면 연결을 닫아 클라이언트가 재연결하게 한다.
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        seq = gallery_feed.decode(since) if since else None
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    if not gallery_streams.acquire(blocking=False):
+        response = jsonify({'error': '실시간 연결이 너무 많습니다. 잠시 후 다시 시도해주세요.'})
+        response.headers['Retry-After'] = str(int(GALLERY_STREAM_KEEPALIVE))
+        return response, 503
+    released = []
+    def release():
+        if not released:
+            released.append(True)
+            gallery_streams.release()
+    
+    # 커서 없이 연결하면 지금부터의 변경만 전송
+    reset = since is not None and (seq is None or gallery_feed.events_after(seq) is None)
+    if since is None or reset:
+        seq = gallery_feed.head
+
+    def event(kind, data, event_seq):
+        return (f"id: {gallery_feed.cursor(event_seq)}\nevent: {kind}\n"
+                f"data: {json.dumps(data, ensure_ascii=False)}\n\n")
+
+    def generate_events():
+        current = seq
+        deadline = time.monotonic() + GALLERY_STREAM_MAX_AGE
+        try:
+            yield 'retry: 3000\n\n'
+            if reset:
+                yield event('reset', {}, current)
+            while time.monotonic() < deadline:
+                if not gallery_feed.wait(current, min(GALLERY_STREAM_KEEPALIVE, deadline - time.monotonic())):
+                    yield ': keep-alive\n\n'
+                    continue
+                events = gallery_feed.events_after(current)
+                if events is None:
+                    # 버퍼가 따라잡을 수 없을 만큼 밀림
+                    current = gallery_feed.head
+                    yield event('reset', {}, current)
+                    continue
+                for event_seq, kind, payload in events:
+                    if kind == 'added':
+                        data = dict(payload, user_liked=False)
+                    elif kind == 'deleted':
+                        data = {'id': payload}
+                    else:
+                        data = {'id': payload[0], 'likes': payload[1]}
+                    yield event(kind, data, event_seq)
+                    current = event_seq
+        finally:
+            release()
+
+    response = Response(generate_events(), mimetype='text/event-stream')
+    # 생성기가 시작되기 전에 연결이 끊겨도 슬롯 반환
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/gallery/search')
+@require_auth
+def api_gallery_search():
+    """프롬프트/응답 텍스트 검색 (정렬: relevance, newest, likes)"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '검색어를 입력해주세요.'}), 400
+    if len(query) > SEARCH_MAX_QUERY:
+        return jsonify({'error': f'검색어는 {SEARCH_MAX_QUERY}자까지 입력할 수 있습니다.'}), 400
+    sort_by = request.args.get('sort', 'relevance')
+    if sort_by not in SEARCH_SORTS:
+        sort_by = 'relevance'
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 15)), 1), MAX_PER_PAGE)
+    except ValueError:
+        return jsonify({'error': '잘못된 페이지 값입니다.'}), 400
+
+    images, has_more, total = gallery_store.search(query, sort_by, (page - 1) * per_page, per_page)
+    annotate_likes(images, get_client_ip())
+    return jsonify({
+        'images': images,
+        'has_more': has_more,
+        'total': total,
+        'query': query,
+        'sort': sort_by,
         'page': page,
         'per_page': per_page
     })
@@ -261,71 +2616,118 @@ def api_gallery():
 @require_auth
 def serve_user_content(filename):
     try:
-        upload_path = os.path.join(UPLOAD_FOLDER, filename)
-        if os.path.exists(upload_path):
-            return send_file(upload_path, as_attachment=False)
-        
-        result_path = os.path.join(RESULT_FOLDER, filename)
-        if os.path.exists(result_path):
-            return send_file(result_path, as_attachment=False)
+        path = content_index.lookup(filename) if not filename.startswith('.') else None
+        if path is None:
+            return jsonify({'error': '파일을 찾을 수 없습니다.'}), 404
         
+        # 조건부 요청(ETag / Last-Modified)과 Range 요청은 send_file이 처리
+        response = send_file(path, as_attachment=False, conditional=True, etag=True,
+                             max_age=USER_CONTENT_MAX_AGE)
+        # 파일명(UUID)은 내용이 바뀌지 않으므로 재검증 없이 캐시
+        response.cache_control.immutable = True
+        response.cache_control.public = USER_CONTENT_CACHE_PUBLIC
+        response.cache_control.private = not USER_CONTENT_CACHE_PUBLIC
+        return response
+    except FileNotFoundError:
+        # 인덱스에 남아 있던 삭제된 파일
+        content_index.unregister(filename)
         return jsonify({'error': '파일을 찾을 수 없습니다.'}), 404
     except Exception as e:
         print(f"파일 서빙 에러: {e}")
         return jsonify({'error': '파일 서빙 중 오류가 발생했습니다.'}), 500
 
-@app.route('/generate', methods=['POST'])
-@require_auth
-def generate_image():
-    try:
-        prompt = request.form.get('prompt', '').strip()
-        if not prompt:
-            return jsonify({'error': '프롬프트를 입력해주세요.'}), 400
+def prepare_generation():
+    """요청 스레드에서 프롬프트와 첨부 파일을 읽어 생성 작업 입력을 준비
 
-        print(f"🎨 이미지 생성 시작: {prompt[:50]}... IP={get_client_ip()} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
+    반환값: (작업 입력 dict, None) 또는 (None, 에러 응답)
+    """
+    prompt = request.form.get('prompt', '').strip()
+    if not prompt:
+        return None, (jsonify({'error': '프롬프트를 입력해주세요.'}), 400)
 
-        parts = [{"text": f"Image generation prompt: {prompt}"}]
-        uploaded_images = []
-        
-        for i in range(1, 3):
-            file_key = f'image{i}'
-            if file_key in request.files:
-                file = request.files[file_key]
-                
-                # 파일이 실제로 업로드되었는지 확인
-                if file and file.filename:
-                    # 파일 유효성 검사
+    client_ip = get_client_ip()
+    # 단계별 소요 시간 (Server-Timing 헤더와 느린 요청 로그에 사용)
+    timer = g.timer = PhaseTimer('generate')
+    timer.info['prompt'] = prompt[:50]
+    print(f"🎨 이미지 생성 시작: {prompt[:50]}... IP={client_ip} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    image_parts, uploaded_images, error_response = prepare_reference_images(timer)
+    if error_response:
+        return None, error_response
+
+    return {
+        'prompt': prompt,
+        'parts': [{"text": f"Image generation prompt: {prompt}"}] + image_parts,
+        'uploaded_images': uploaded_images,
+        'client_ip': client_ip,
+        'timer': timer
+    }, None
+
+def prepare_reference_images(timer):
+    """첨부 이미지(image1, image2)를 검사/저장하고 inlineData part 목록 생성
+
+    반환값: (part 목록, 업로드 정보 목록, None) 또는 (None, None, 에러 응답)
+    저장된 첨부 이미지마다 참조 1개를 잡는다.
+    """
+    parts = []
+    uploaded_images = []
+    
+    for i in range(1, 3):
+        file_key = f'image{i}'
+        if file_key in request.files:
+            file = request.files[file_key]
+            
+            # 파일이 실제로 업로드되었는지 확인
+            if file and file.filename:
+                # 파일 유효성 검사
+                with timer.phase('validate'):
                     is_valid, message = validate_image_file(file)
-                    if not is_valid:
-                        return jsonify({'error': message}), 400
+                if not is_valid:
+                    upload_store.release(upload_filenames(uploaded_images))
+                    return None, None, (jsonify({'error': message}), 400)
+                
+                try:
+                    # 실제 형식 판별 후 예산을 넘는 이미지는 축소/재압축
+                    with timer.phase('preprocess'):
+                        source, mime_type = preprocess_upload(file.stream)
+                    # 같은 내용은 한 번만 저장 (base64 인코딩은 전송하면서 스트리밍으로)
+                    with timer.phase('store'):
+                        file_id, upload_path = upload_store.store(source, mime_type)
+                    
+                    parts.append({
+                        "inlineData": {
+                            "mimeType": mime_type,
+                            "data": InlineFile(upload_path)
+                        }
+                    })
                     
-                    try:
-                        image_bytes = file.read()
-                        base64_image = base64.b64encode(image_bytes).decode("utf-8")
-                        
-                        parts.append({
-                            "inlineData": {
-                                "mimeType": file.content_type,
-                                "data": base64_image
-                            }
-                        })
-                        
-                        file_id = f"{str(uuid.uuid4())}.png"
-                        file_path = os.path.join(UPLOAD_FOLDER, file_id)
-                        with open(file_path, 'wb') as f:
-                            f.write(image_bytes)
-                        
-                        uploaded_images.append({
-                            'filename': file.filename,
-                            'path': f"/user_content/{file_id}"
-                        })
-                        
-                        print(f"📁 파일 업로드 성공: {file.filename} ({round(len(image_bytes)/(1024*1024), 2)}MB)")
-                        
-                    except Exception as e:
-                        print(f"❌ 파일 처리 오류: {e}")
-                        return jsonify({'error': f'파일 처리 중 오류가 발생했습니다: {file.filename}'}), 400
+                    uploaded_images.append({
+                        'filename': file.filename,
+                        'path': f"/user_content/{file_id}"
+                    })
+                    
+                    print(f"📁 파일 업로드 성공: {file.filename} ({round(os.path.getsize(upload_path)/(1024*1024), 2)}MB)")
+                    
+                except Exception as e:
+                    print(f"❌ 파일 처리 오류: {e}")
+                    upload_store.release(upload_filenames(uploaded_images))
+                    return None, None, (jsonify({'error': f'파일 처리 중 오류가 발생했습니다: {file.filename}'}), 400)
 
+    return parts, uploaded_images, None
+
+def run_generation(prompt, parts, uploaded_images, client_ip, timer=None, admission=None, variant=None):
+    """업스트림 호출부터 결과 저장, 갤러리 등록까지 수행 (요청 컨텍스트 불필요)
+
+    반환값: (응답 dict, HTTP 상태 코드)
+    """
+    if timer is None:
+        timer = PhaseTimer('generate')
+    if timer.queued_at is not None:
+        timer.add('queue', time.monotonic() - timer.queued_at)
+    items_created = 0
+    status_code = 500
+    GENERATIONS_IN_FLIGHT.inc()
+    try:
         payload = {
             "contents": [{"role": "user", "parts": parts}],
             "generationConfig": {"maxOutputTokens": 4000, "temperature": 1},
@@ -339,12 +2741,16 @@ def generate_image():
         }
 
         try:
-            data = send_request_sync(payload)
+            # 동일한 프롬프트/이미지/설정 요청은 업스트림 호출 하나를 공유
+            key = generation_key(parts, uploaded_images, payload, variant)
+            # 병합된 요청은 대표 요청의 직렬화/파싱 시간이 대표 요청 쪽에만 기록됨
+            with timer.phase('upstream'):
+                data = upstream_coalescer.call(key, lambda: send_request_sync(payload, timer))
         except Exception as api_error:
             error_msg = str(api_error)
             # Google AI 키 관련 에러는 원본 메시지 그대로 전달
             if "No Google AI keys available" in error_msg or "No billing-enabled Google AI keys available" in error_msg:
-                return jsonify({'error': error_msg}), 500
+                return {'error': error_msg}, 500
             else:
                 # 다른 에러는 기존대로
                 raise api_error
@@ -356,21 +2762,21 @@ def generate_image():
                 if "text" in part:
                     response_text += part["text"] + "\n"
                 elif "inlineData" in part:
-                    base64_data = part["inlineData"]["data"]
-                    image_data = base64.b64decode(base64_data)
-                    
                     result_id = f"{str(uuid.uuid4())}.png"
                     result_path = os.path.join(RESULT_FOLDER, result_id)
-                    with open(result_path, 'wb') as f:
-                        f.write(image_data)
+                    # 응답 이미지는 수신 중에 스필 파일로 디코딩되어 있으므로 링크만 생성
+                    with timer.phase('write'):
+                        result_size = save_inline_image(part["inlineData"], result_path)
+                    content_index.register(result_path)
+                    storage_manager.track(result_size)
                     result_image_path = f"/user_content/{result_id}"
                     
                     # 한국 시간으로 저장 (기존 코드에서)
                     korean_time = get_korean_time()
-                    client_ip = get_client_ip()
                     
+                    image_id = result_id.replace('.png', '')
                     gallery_item = {
-                        'id': result_id.replace('.png', ''),
+                        'id': image_id,
                         'result_image': result_image_path,
                         'prompt': prompt,
                         'uploaded_images': uploaded_images,
@@ -379,69 +2785,249 @@ def generate_image():
                         'likes': 0,
                         'creator_ip': client_ip  # IP 기록 추가
                     }
-                    image_gallery.append(gallery_item)
-                    
-                    # 이미지ID와 IP 매핑 저장
-                    image_creators[gallery_item['id']] = client_ip
+                    # 갤러리 인덱스에 추가 (이미지ID와 생성자 IP 매핑도 함께 저장)
+                    with timer.phase('db'):
+                        gallery_store.add(gallery_item)
+                    # 갤러리 그리드용 썸네일 / WebP는 응답을 늦추지 않도록 백그라운드에서 만들어 나중에 반영
+                    derivative_executor.submit(build_derivatives, result_path, image_id)
+                    items_created += 1
                     
                     print(f"✅ 이미지 생성 완료: ID={gallery_item['id']} 한국시간={korean_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
         if result_image_path:
-            return jsonify({
+            status_code = 200
+            return {
                 'success': True,
                 'result_image': result_image_path,
                 'response_text': response_text.strip()
-            })
+            }, 200
         else:
             # 🎯 data 응답 안에서 Google AI 키 에러 체크
             data_str = str(data)
             if "No Google AI keys available" in data_str or "No billing-enabled Google AI keys available" in data_str:
-                return jsonify({'error': 'No Google AI keys available'}), 500
+                return {'error': 'No Google AI keys available'}, 500
             else:
-                return jsonify({'error': 'AI로부터 이미지를 받지 못했습니다.'}), 500
+                return {'error': 'AI로부터 이미지를 받지 못했습니다.'}, 500
 
     except Exception as e:
         print(f"❌ 에러 발생: {e} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
         import traceback
         traceback.print_exc()
+        return {'error': f'오류 발생: {str(e)}'}, 500
+    finally:
+        GENERATIONS_IN_FLIGHT.dec()
+        if admission is not None:
+            admission.release()
+        timer.finish()
+        slow_requests.record(timer, status_code)
+        # 첨부 이미지 참조는 준비 단계에서 1개 잡혀 있으므로 생성된 갤러리 항목 수에 맞춤
+        filenames = upload_filenames(uploaded_images)
+        if items_created == 0:
+            upload_store.release(filenames)
+        elif items_created > 1:
+            upload_store.retain(filenames, items_created - 1)
+
+@app.route('/generate', methods=['POST'])
+@require_auth
+def generate_image():
+    """동기 생성 (기존 클라이언트 호환용, 응답까지 요청 스레드를 점유)"""
+    try:
+        job_input, error_response = prepare_generation()
+        if error_response:
+            return error_response
+    except Exception as e:
+        print(f"❌ 에러 발생: {e} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
         return jsonify({'error': f'오류 발생: {str(e)}'}), 500
 
+    result, status_code = run_generation(**job_input)
+    return jsonify(result), status_code
+
+@app.route('/api/generate', methods=['POST'])
+@require_auth
+def submit_generation_job():
+    """비동기 생성 작업 등록: 작업 ID를 즉시 반환하고 워커 풀에서 실행"""
+    try:
+        job_input, error_response = prepare_generation()
+        if error_response:
+            return error_response
+    except Exception as e:
+        print(f"❌ 에러 발생: {e} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
+        return jsonify({'error': f'오류 발생: {str(e)}'}), 500
+
+    job_input['timer'].queued_at = time.monotonic()
+    # 수용 슬롯은 요청이 끝나도 유지하고 작업이 끝날 때 반환
+    job_input['admission'] = g.pop('admission', None)
+    try:
+        job = generation_jobs.submit(run_generation, **job_input)
+    except JobQueueFull:
+        if job_input['admission'] is not None:
+            job_input['admission'].release()
+        upload_store.release(upload_filenames(job_input['uploaded_images']))
+        response = jsonify({'error': '생성 대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요.'})
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response, 429
+
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': url_for('get_generation_job', job_id=job['id'])
+    }), 202
+
+@app.route('/api/generate/<job_id>')
+@require_auth
+def get_generation_job(job_id):
+    """생성 작업 상태 조회 (wait=초 지정 시 완료될 때까지 롱폴링)"""
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), JOB_MAX_WAIT)
+    except ValueError:
+        return jsonify({'error': '잘못된 wait 값입니다.'}), 400
+
+    job = generation_jobs.wait(job_id, wait) if wait else generation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '작업을 찾을 수 없습니다.'}), 404
+
+    body = {'job_id': job['id'], 'status': job['status']}
+    if job['status'] in ('done', 'failed'):
+        body['result'] = job['result']
+        # 작업의 단계별 시간을 완료 시점 상태 조회 응답의 Server-Timing에 실음
+        if job['timer'] is not None:
+            g.timer = job['timer']
+    return jsonify(body)
+
+@app.route('/api/generate/batch', methods=['POST'])
+@require_auth
+def generate_batch():
+    """여러 프롬프트/변형을 한 번에 생성
+
+    첨부 이미지는 한 번만 검사/저장하고 항목마다 공유한다. 업스트림 호출은 배치당 parallelism개까지
+    동시에 보내며(키는 스케줄러가 항목마다 선택), 결과는 끝나는 순서대로 NDJSON 한 줄씩 스트리밍한다.
+    stream=0이면 모두 끝난 뒤 JSON으로 한 번에 반환한다.
+    """
+    prompts = [p.strip() for p in request.form.getlist('prompts') + request.form.getlist('prompt') if p.strip()]
+    if not prompts:
+        return jsonify({'error': '프롬프트를 입력해주세요.'}), 400
+    try:
+        variants = int(request.form.get('variants', 1))
+        parallelism = int(request.form.get('parallelism', BATCH_PARALLELISM))
+    except ValueError:
+        return jsonify({'error': '잘못된 variants/parallelism 값입니다.'}), 400
+    total = len(prompts) * variants
+    # 항목마다 토큰 1개를 쓰므로 속도 제한이 켜져 있으면 버킷 크기보다 큰 배치는 받을 수 없음
+    max_items = min(BATCH_MAX_ITEMS, admission_control.burst) if GENERATE_RATE_PER_MIN > 0 else BATCH_MAX_ITEMS
+    if variants < 1 or total > max_items:
+        return jsonify({'error': f'배치는 최대 {max_items}개까지 생성할 수 있습니다.'}), 400
+    parallelism = min(max(parallelism, 1), BATCH_PARALLELISM, total)
+    stream = request.args.get('stream', request.form.get('stream', '1')).lower() not in ('0', 'false', 'no')
+
+    # 수용 단계에서 1건으로 잡힌 슬롯을 항목 수만큼 늘리고, 배치가 끝날 때 반환
+    ticket = g.pop('admission', None)
+    if ticket is not None:
+        rejection = admission_control.extend(ticket, total - 1)
+        if rejection:
+            ticket.release()
+            return admission_rejected(*rejection)
+
+    client_ip = get_client_ip()
+    timer = g.timer = PhaseTimer('batch')
+    image_parts, uploaded_images, error_response = prepare_reference_images(timer)
+    if error_response:
+        if ticket is not None:
+            ticket.release()
+        return error_response
+    # 첨부 이미지 참조는 항목마다 1개 (각 run_generation이 만든 결과 수에 맞춰 조정)
+    filenames = upload_filenames(uploaded_images)
+    if total > 1:
+        upload_store.retain(filenames, total - 1)
+
+    items = [(prompt, variant) for prompt in prompts for variant in range(variants)]
+    print(f"🎨 배치 생성 시작: 프롬프트 {len(prompts)}개 × 변형 {variants}개 (동시 {parallelism}) IP={client_ip}")
+
+    def run_item(index):
+        prompt, variant = items[index]
+        item_timer = PhaseTimer('batch_item')
+        item_timer.info['prompt'] = prompt[:50]
+        parts = [{"text": f"Image generation prompt: {prompt}"}] + image_parts
+        return run_generation(prompt, parts, uploaded_images, client_ip, timer=item_timer,
+                              variant=variant if variants > 1 else None)
+
+    def completed():
+        """끝난 순서대로 (번호, 결과, 상태 코드)"""
+        pending = {}
+        submitted = 0
+        try:
+            while pending or submitted < total:
+                while submitted < total and len(pending) < parallelism:
+                    pending[batch_executor.submit(run_item, submitted)] = submitted
+                    submitted += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    result, status_code = future.result()
+                    yield index, result, status_code
+        finally:
+            # 클라이언트가 끊기면 보내지 않은 항목은 취소 (이미 보낸 요청은 끝까지 처리해 갤러리에 추가)
+            for _ in range(total - submitted):
+                upload_store.release(filenames)
+            if ticket is not None:
+                if pending:
+                    remaining = list(pending)
+                    threading.Thread(target=lambda: (wait(remaining), ticket.release()), daemon=True).start()
+                else:
+                    ticket.release()
+
+    def entry(index, result, status_code):
+        prompt, variant = items[index]
+        return {'index': index, 'prompt': prompt, 'variant': variant, 'status': status_code, **result}
+
+    if not stream:
+        results = [None] * total
+        for index, result, status_code in completed():
+            results[index] = entry(index, result, status_code)
+        succeeded = sum(1 for item in results if item['status'] == 200)
+        return jsonify({'results': results, 'succeeded': succeeded, 'failed': total - succeeded})
+
+    def generate_lines():
+        succeeded = 0
+        for index, result, status_code in completed():
+            succeeded += status_code == 200
+            yield json.dumps(entry(index, result, status_code), ensure_ascii=False) + '\n'
+        yield json.dumps({'done': True, 'succeeded': succeeded, 'failed': total - succeeded}) + '\n'
+
+    response = Response(generate_lines(), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 프록시 버퍼링 없이 결과마다 바로 전달
+    return response
+
 @app.route('/like/<image_id>', methods=['POST'])
 @require_auth
 def like_image(image_id):
     client_ip = get_client_ip()
     
-    if client_ip not in like_records:
-        like_records[client_ip] = set()
-    
-    if image_id in like_records[client_ip]:
+    status, likes = like_counter.like(client_ip, image_id)
+    if status == 'already':
         return jsonify({'error': '이미 좋아요를 누른 이미지입니다.', 'already_liked': True}), 400
+    if status == 'missing':
+        return jsonify({'error': '이미지를 찾을 수 없습니다.'}), 404
     
-    for item in image_gallery:
-        if item['id'] == image_id:
-            item['likes'] += 1
-            like_records[client_ip].add(image_id)
-            print(f"❤️ 좋아요: ID={image_id} IP={client_ip} 총 좋아요={item['likes']} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
-            return jsonify({
-                'success': True, 
-                'likes': item['likes'],
-                'user_liked': True
-            })
-    
-    return jsonify({'error': '이미지를 찾을 수 없습니다.'}), 404
+    print(f"❤️ 좋아요: ID={image_id} IP={client_ip} 총 좋아요={likes} 시간={get_korean_time().strftime('%Y-%m-%d %H:%M:%S')}")
+    return jsonify({
+        'success': True, 
+        'likes': likes,
+        'user_liked': True
+    })
 
 @app.route('/image/<image_id>')
 @require_auth
 def get_image_details(image_id):
     client_ip = get_client_ip()
-    user_likes = like_records.get(client_ip, set())
     
-    for item in image_gallery:
-        if item['id'] == image_id:
-            item_data = item.copy()
-            item_data['user_liked'] = image_id in user_likes
-            return jsonify(item_data)
-    return jsonify({'error': '이미지를 찾을 수 없습니다.'}), 404
+    item = gallery_store.get(image_id)
+    if item is None:
+        return jsonify({'error': '이미지를 찾을 수 없습니다.'}), 404
+    
+    item['likes'] += like_counter.pending_delta(image_id)
+    item['user_liked'] = like_counter.has_liked(client_ip, image_id)
+    return jsonify(item)
 
 # 에러 핸들러도 인증 체크
 @app.errorhandler(401)
@@ -471,42 +3057,21 @@ def admin_delete_images():
         banned_ips_count = 0
         creator_ips = set()
         
-        # 이미지 삭제 및 IP 수집
-        global image_gallery
-        new_gallery = []
-        
-        for item in image_gallery:
-            if item['id'] in image_ids:
-                # 파일 삭제
-                try:
-                    file_path = item['result_image'].replace('/user_content/', '')
-                    result_path = os.path.join(RESULT_FOLDER, file_path)
-                    if os.path.exists(result_path):
-                        os.remove(result_path)
-                    
-                    # 첨부 이미지도 삭제
-                    if item.get('uploaded_images'):
-                        for img in item['uploaded_images']:
-                            img_path = img['path'].replace('/user_content/', '')
-                            upload_path = os.path.join(UPLOAD_FOLDER, img_path)
-                            if os.path.exists(upload_path):
-                                os.remove(upload_path)
-                except Exception as e:
-                    print(f"파일 삭제 오류: {e}")
-                
-                # IP 수집
-                creator_ip = item.get('creator_ip') or image_creators.get(item['id'])
-                if creator_ip:
-                    creator_ips.add(creator_ip)
-                
-                deleted_count += 1
-            else:
-                new_gallery.append(item)
+        # 갤러리에서 즉시 제거하고, 파일 삭제는 저장소 관리 스레드에 맡김
+        removed = gallery_store.remove_many(image_ids)
+        storage_manager.delete_items_async(removed)
         
-        image_gallery = new_gallery
+        # IP 수집
+        for item in removed:
+            creator_ip = item.get('creator_ip')
+            if creator_ip:
+                creator_ips.add(creator_ip)
+            
+            deleted_count += 1
         
         # IP 밴 처리
         if ban_users and creator_ips:
+            gallery_store.add_bans(creator_ips)
             banned_ips.update(creator_ips)
             banned_ips_count = len(creator_ips)
             print(f"🚫 IP 밴: {creator_ips}")
@@ -531,17 +3096,43 @@ def admin_status():
     return jsonify({
         'is_admin': session.get('admin', False),
         'banned_ips_count': len(banned_ips),
-        'total_images': len(image_gallery)
+        'total_images': len(gallery_store),
+        'api_keys': key_scheduler.stats() if session.get('admin') else None,
+        'hedging': hedge_policy.stats() if session.get('admin') else None,
+        'coalescing': upstream_coalescer.stats() if session.get('admin') else None,
+        'storage': storage_manager.stats() if session.get('admin') else None,
+        'admission': admission_control.stats() if session.get('admin') else None
     })
 
+@app.route('/api/admin/slow_requests')
+@require_auth
+def admin_slow_requests():
+    """최근 생성 요청 중 가장 느린 요청들의 단계별 소요 시간"""
+    if not session.get('admin'):
+        return jsonify({'error': '어드민 권한이 필요합니다.'}), 403
+
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), SLOW_LOG_CAPACITY)
+    except ValueError:
+        return jsonify({'error': '잘못된 limit 값입니다.'}), 400
+    return jsonify({'requests': slow_requests.slowest(limit)})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 스크레이프용 메트릭 (모든 값은 증분 유지되므로 갤러리 크기와 무관)"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': '인증이 필요합니다.'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # 서버 상태 체크 (선택사항)
 @app.route('/health')
 def health_check():
     return jsonify({
         'status': 'healthy',
         'server_time_kst': get_korean_time().strftime('%Y-%m-%d %H:%M:%S'),
-        'total_images': len(image_gallery),
-        'total_likes': sum(item['likes'] for item in image_gallery)
+        'total_images': len(gallery_store),
+        'total_likes': gallery_store.total_likes() + like_counter.pending_total(),
+        'generation_queue': generation_jobs.stats()
     })
 
 if __name__ == '__main__':
@@ -550,4 +3141,5 @@ if __name__ == '__main__':
     print(f"🇰🇷 서버 시간: {get_korean_time().strftime('%Y-%m-%d %H:%M:%S KST')}")
     print(f"📁 업로드 폴더: {UPLOAD_FOLDER}")
     print(f"📁 결과 폴더: {RESULT_FOLDER}")
+    print(f"🗄️ 갤러리 DB: {GALLERY_DB_PATH} ({len(gallery_store)}개 이미지)")
     app.run(host="0.0.0.0", port=7860, debug=True)
@@ -0,0 +1,305 @@
+"""부하 테스트 / 벤치마크 실행기
+
+로컬 스텁 Gemini 서버(stub_gemini.py)를 띄우고, 갤러리 크기별로 앱 서버(serve_app.py)를
+하위 프로세스로 실행한 뒤 /generate, /api/gallery(모든 정렬), /like, /user_content에
+동시 요청을 보내 처리량과 p50/p95/p99 지연을 JSON으로 출력한다.
+
+    python bench/run_bench.py                                  # 1천 / 10만 / 100만 항목 전체 실행
+    python bench/run_bench.py --sizes 1000 --requests 200 --output bench.json
+    python bench/run_bench.py --mode api_url --error-rate 0.05 --rate-limit-rate 0.1
+
+시드된 갤러리 DB는 --workdir에 크기별로 남겨 두고 다음 실행에서 재사용한다.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stub_gemini import DEFAULT_CONFIG, make_png, start_stub
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SITE_PASSWORD = 'bench-password'
+GALLERY_SORTS = ('newest', 'oldest', 'likes')
+PER_PAGE = 15
+CURSOR_WALK_PAGES = 20   # 커서 순회 시나리오에서 처음으로 돌아가기 전까지 넘길 페이지 수
+
+def log(message):
+    # 표준 출력은 JSON 결과용으로 비워 둠
+    print(message, file=sys.stderr, flush=True)
+
+def percentile(sorted_values, pct):
+    """nearest-rank 백분위수"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+class LoadDriver:
+    """스레드마다 로그인된 세션 하나로 요청을 보내고 지연 시간을 수집"""
+
+    def __init__(self, base_url, concurrency):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self._local = threading.local()
+
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.post(f"{self.base_url}/login", data={'password': SITE_PASSWORD},
+                         allow_redirects=False).raise_for_status()
+            self._local.session = session
+            self._local.state = {}
+        return session
+
+    def state(self):
+        """시나리오가 스레드별로 이어 쓰는 상태 (예: 커서 순회 위치)"""
+        self.session()
+        return self._local.state
+
+    def run(self, name, total, make_request, on_response=None):
+        """make_request(driver, i) -> requests.Response 를 total번 실행하고 요약 반환"""
+        latencies = []
+        statuses = Counter()
+        lock = threading.Lock()
+
+        def task(i):
+            started = time.perf_counter()
+            try:
+                response = make_request(self, i)
+                status = response.status_code
+            except requests.RequestException as e:
+                response, status = None, type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+            if response is not None and on_response is not None:
+                on_response(response)
+
+        # 로그인은 측정에서 제외
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            list(pool.map(lambda _: self.session(), range(self.concurrency)))
+            started = time.perf_counter()
+            list(pool.map(task, range(total)))
+            duration = time.perf_counter() - started
+
+        latencies.sort()
+        ok = sum(count for status, count in statuses.items() if isinstance(status, int) and status < 400)
+        result = {
+            'scenario': name,
+            'requests': total,
+            'concurrency': self.concurrency,
+            'duration_s': round(duration, 3),
+            'throughput_rps': round(total / duration, 2) if duration else None,
+            'success': ok,
+            'errors': total - ok,
+            'status_counts': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50) * 1000, 2),
+                'p95': round(percentile(latencies, 95) * 1000, 2),
+                'p99': round(percentile(latencies, 99) * 1000, 2),
+                'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+                'max': round(latencies[-1] * 1000, 2)
+            }
+        }
+        log(f"  {name}: {result['throughput_rps']} req/s, p50={result['latency_ms']['p50']}ms "
+            f"p99={result['latency_ms']['p99']}ms, 오류 {result['errors']}")
+        return result
+
+# --- 시나리오 ---
+
+def gallery_first_page(sort):
+    def make_request(driver, i):
+        return driver.session().get(f"{driver.base_url}/api/gallery",
+                                    params={'sort': sort, 'cursor': '', 'per_page': PER_PAGE})
+    return make_request
+
+def gallery_cursor_walk(sort):
+    def make_request(driver, i):
+        state = driver.state()
+        cursor = state.get(sort) or ''
+        response = driver.session().get(f"{driver.base_url}/api/gallery",
+                                        params={'sort': sort, 'cursor': cursor, 'per_page': PER_PAGE})
+        pages = state.get(f'{sort}_pages', 0) + 1
+        next_cursor = response.json().get('next_cursor') if response.ok else None
+        if next_cursor is None or pages >= CURSOR_WALK_PAGES:
+            next_cursor, pages = None, 0
+        state[sort], state[f'{sort}_pages'] = next_cursor, pages
+        return response
+    return make_request
+
+def gallery_offset_deep(sort, gallery_size):
+    last_page = max(gallery_size // PER_PAGE, 1)
+    def make_request(driver, i):
+        return driver.session().get(f"{driver.base_url}/api/gallery",
+                                    params={'sort': sort, 'page': random.randint(1, last_page), 'per_page': PER_PAGE})
+    return make_request
+
+def generate(image_bytes):
+    # 업로드 검증이 매직 바이트를 확인하므로 실제 PNG를 첨부
+    attachment = make_png(image_bytes) if image_bytes else None
+    def make_request(driver, i):
+        # 프롬프트를 매번 다르게 해서 동일 요청 병합/캐시에 걸리지 않게 함
+        data = {'prompt': f"benchmark {uuid.uuid4().hex}"}
+        files = {'image1': ('bench.png', attachment, 'image/png')} if attachment else None
+        return driver.session().post(f"{driver.base_url}/generate", data=data, files=files)
+    return make_request
+
+def like(gallery_size):
+    def make_request(driver, i):
+        image_id = f"bench-{random.randrange(gallery_size):08d}"
+        # 요청마다 다른 IP로 보여야 좋아요가 실제로 기록됨
+        ip = f"172.{random.randint(16, 31)}.{random.randint(0, 255)}.{random.randint(1, 254)}"
+        return driver.session().post(f"{driver.base_url}/like/{image_id}", headers={'X-Forwarded-For': ip})
+    return make_request
+
+def user_content(paths):
+    def make_request(driver, i):
+        return driver.session().get(f"{driver.base_url}{random.choice(paths)}")
+    return make_request
+
+# --- 실행 ---
+
+def wait_ready(base_url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"앱 서버가 종료됨 (코드 {process.returncode})")
+        try:
+            if requests.get(f"{base_url}/health", timeout=2).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('앱 서버 시작 대기 시간 초과')
+
+def app_env(args, stub_url, size):
+    env = dict(os.environ)
+    run_dir = os.path.join(args.workdir, f'run-{size}')
+    env.update({
+        'SITE_PASSWORD': SITE_PASSWORD,
+        'GALLERY_DB_PATH': os.path.join(args.workdir, f'gallery-{size}.db'),
+        'UPLOAD_FOLDER': os.path.join(run_dir, 'uploads'),
+        'RESULT_FOLDER': os.path.join(run_dir, 'results'),
+        # 부하 요청이 모두 127.0.0.1에서 오므로 IP별 수용 제한은 끔 (전체 대기 한도는 유지)
+        'GENERATE_RATE_PER_MIN': '0',
+        'GENERATE_MAX_PER_IP': '0'
+    })
+    if args.mode == 'keys':
+        env['API_KEY'] = ','.join(f'bench-key-{i + 1}' for i in range(args.keys))
+        env['GEMINI_API_BASE'] = stub_url
+        env.pop('API_URL', None)
+    else:
+        env['API_URL'] = f"{stub_url}/v1beta/models/stub:generateContent"
+        env.pop('API_KEY', None)
+    return env
+
+def run_size(args, stub_url, size):
+    log(f"📊 갤러리 {size}개")
+    base_url = f"http://127.0.0.1:{args.port}"
+    log_path = os.path.join(args.workdir, f'server-{size}.log')
+    with open(log_path, 'w') as server_log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'serve_app.py'), '--port', str(args.port), '--seed', str(size)],
+            env=app_env(args, stub_url, size), stdout=server_log, stderr=subprocess.STDOUT)
+    try:
+        wait_ready(base_url, process, args.startup_timeout)
+        driver = LoadDriver(base_url, args.concurrency)
+        scenarios = set(args.scenarios.split(','))
+        results = []
+
+        if 'gallery' in scenarios:
+            for sort in GALLERY_SORTS:
+                results.append(driver.run(f'gallery_first_page_{sort}', args.requests, gallery_first_page(sort)))
+                results.append(driver.run(f'gallery_cursor_walk_{sort}', args.requests, gallery_cursor_walk(sort)))
+                results.append(driver.run(f'gallery_offset_deep_{sort}', args.requests, gallery_offset_deep(sort, size)))
+
+        content_paths = []
+        if 'generate' in scenarios:
+            def collect(response):
+                if response.ok and response.json().get('result_image'):
+                    content_paths.append(response.json()['result_image'])
+            results.append(driver.run('generate', args.generate_requests, generate(args.attach_bytes), collect))
+
+        if 'like' in scenarios and size:
+            results.append(driver.run('like', args.requests, like(size)))
+
+        if 'user_content' in scenarios:
+            if content_paths:
+                results.append(driver.run('user_content', args.requests, user_content(content_paths)))
+            else:
+                log('  user_content: 생성된 결과 파일이 없어 건너뜀 (generate 시나리오 필요)')
+
+        return {'gallery_size': size, 'scenarios': results}
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description='banana-hugging 부하 테스트')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='갤러리 항목 수 (쉼표 구분)')
+    parser.add_argument('--scenarios', default='gallery,generate,like,user_content')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help='시나리오별 요청 수')
+    parser.add_argument('--generate-requests', type=int, default=100)
+    parser.add_argument('--attach-bytes', type=int, default=0, help='/generate 요청에 첨부할 파일 크기 (0이면 첨부 없음)')
+    parser.add_argument('--mode', choices=('keys', 'api_url'), default='keys', help='업스트림 라우팅 방식')
+    parser.add_argument('--keys', type=int, default=4, help='keys 모드에서 사용할 API 키 수')
+    parser.add_argument('--invalid-keys', type=int, default=0, help='그중 무효 키로 응답할 키 수')
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_CONFIG['latency_ms'])
+    parser.add_argument('--jitter-ms', type=float, default=DEFAULT_CONFIG['jitter_ms'])
+    parser.add_argument('--slow-rate', type=float, default=DEFAULT_CONFIG['slow_rate'])
+    parser.add_argument('--slow-ms', type=float, default=DEFAULT_CONFIG['slow_ms'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_CONFIG['error_rate'])
+    parser.add_argument('--rate-limit-rate', type=float, default=DEFAULT_CONFIG['rate_limit_rate'])
+    parser.add_argument('--image-bytes', type=int, default=DEFAULT_CONFIG['image_bytes'])
+    parser.add_argument('--port', type=int, default=7861)
+    parser.add_argument('--startup-timeout', type=float, default=600, help='시드 포함 앱 서버 시작 대기(초)')
+    parser.add_argument('--workdir', default='/tmp/banana-bench')
+    parser.add_argument('--output', default='-', help='결과 JSON 파일 (-이면 표준 출력)')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    stub_config = {name: getattr(args, name) for name in
+                   ('latency_ms', 'jitter_ms', 'slow_rate', 'slow_ms', 'error_rate', 'rate_limit_rate', 'image_bytes')}
+    stub_config['invalid_keys'] = [f'bench-key-{i + 1}' for i in range(args.keys - args.invalid_keys, args.keys)]
+    stub_server, stub_url = start_stub(**stub_config)
+    log(f"🧪 스텁 Gemini 서버: {stub_url}")
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'workdir', 'port')},
+        'stub': stub_config,
+        'results': []
+    }
+    try:
+        for size in (int(s) for s in args.sizes.split(',') if s.strip()):
+            report['results'].append(run_size(args, stub_url, size))
+    finally:
+        report['stub_stats'] = requests.get(f"{stub_url}/_stats").json()
+        stub_server.shutdown()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        log(f"💾 결과 저장: {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""벤치마크용 앱 서버: 갤러리를 N개 항목으로 채운 뒤 멀티스레드 WSGI 서버로 실행
+
+run_bench.py가 환경 변수(GALLERY_DB_PATH, GEMINI_API_BASE 등)를 지정해 하위 프로세스로 띄운다.
+
+    python bench/serve_app.py --port 7861 --seed 100000
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+from datetime import timedelta
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as gallery_app
+
+SEED_BATCH = 10000
+
+def seed_gallery(target):
+    """갤러리 항목 수가 target이 될 때까지 가짜 항목 추가 (이미 채워진 DB는 재사용)"""
+    store = gallery_app.gallery_store
+    missing = target - len(store)
+    if missing <= 0:
+        return
+    rng = random.Random(target)
+    started = gallery_app.get_korean_time() - timedelta(seconds=target)
+    offset = len(store)
+    for start in range(offset, target, SEED_BATCH):
+        batch = []
+        for i in range(start, min(start + SEED_BATCH, target)):
+            image_id = f"bench-{i:08d}"
+            batch.append({
+                'id': image_id,
+                'result_image': f"/user_content/{image_id}.png",
+                'prompt': f"benchmark prompt {i}",
+                'uploaded_images': [],
+                'response_text': '',
+                'created_at': (started + timedelta(seconds=i)).isoformat(),
+                # 좋아요 순 정렬이 의미 있도록 롱테일 분포
+                'likes': int(rng.paretovariate(1.5)) - 1,
+                'creator_ip': f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+            })
+        store.add_many(batch)
+    print(f"🌱 갤러리 시드 완료: {len(store)}개", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='벤치마크용 앱 서버')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7861)
+    parser.add_argument('--seed', type=int, default=0, help='갤러리 항목 수')
+    args = parser.parse_args()
+
+    seed_gallery(args.seed)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(args.host, args.port, gallery_app.app, threaded=True)
+    print(f"🚀 벤치마크 앱 서버: http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""generateContent 엔드포인트를 흉내 내는 로컬 스텁 서버 (벤치마크/부하 테스트용)
+
+    python bench/stub_gemini.py --port 8089 --latency-ms 800 --jitter-ms 400 \\
+        --error-rate 0.02 --rate-limit-rate 0.05 --invalid-keys bench-key-4 --image-bytes 1500000
+
+앱 쪽에서는 키 라우팅을 쓰면 GEMINI_API_BASE=http://127.0.0.1:8089,
+API_URL 방식이면 API_URL=http://127.0.0.1:8089/v1beta/models/stub:generateContent 로 지정.
+
+- POST .../{model}:generateContent?key=KEY  실제 API와 같은 형식의 응답 (텍스트 + PNG inlineData)
+- GET  /_stats                              처리 결과별 요청 수
+- GET/POST /_config                         현재 설정 조회 / 실행 중 변경 (JSON)
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+DEFAULT_CONFIG = {
+    'latency_ms': 500,        # 기본 응답 지연
+    'jitter_ms': 200,         # 0~jitter_ms 균등 분포로 추가 지연
+    'slow_rate': 0.0,         # 꼬리 지연 비율 (헤지 확인용)
+    'slow_ms': 5000,          # 꼬리 지연 요청의 추가 지연
+    'error_rate': 0.0,        # 500 응답 비율
+    'rate_limit_rate': 0.0,   # 429 응답 비율
+    'retry_after': 1,         # 429 응답의 Retry-After(초), 0이면 헤더 없음
+    'invalid_keys': [],       # 항상 API_KEY_INVALID(400)를 돌려줄 키
+    'image_bytes': 1024 * 1024,   # 결과 PNG 크기 (근사치)
+    'text': 'stub response'
+}
+
+def make_png(target_bytes):
+    """대략 target_bytes 크기의 PNG (무작위 픽셀이라 압축되지 않음)"""
+    side = max(int((target_bytes / 3) ** 0.5), 8)
+    image = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue()
+
+def error_body(code, status, message, reason=None):
+    error = {'code': code, 'message': message, 'status': status}
+    if reason:
+        error['details'] = [{'@type': 'type.googleapis.com/google.rpc.ErrorInfo', 'reason': reason}]
+    return {'error': error}
+
+class StubState:
+    """설정, 미리 만들어 둔 응답 본문, 결과별 카운터"""
+
+    def __init__(self, config):
+        self._lock = threading.Lock()
+        self.config = dict(DEFAULT_CONFIG)
+        self.counts = {}
+        self.bytes_received = 0
+        self._body = None
+        self.update(config)
+
+    def update(self, changes):
+        with self._lock:
+            self.config.update({k: v for k, v in changes.items() if k in DEFAULT_CONFIG})
+            # 이미지 base64 인코딩은 요청마다 하지 않고 설정이 바뀔 때 한 번만
+            png = make_png(int(self.config['image_bytes']))
+            self._body = json.dumps({
+                'candidates': [{
+                    'content': {'role': 'model', 'parts': [
+                        {'text': self.config['text']},
+                        {'inlineData': {'mimeType': 'image/png', 'data': base64.b64encode(png).decode('ascii')}}
+                    ]},
+                    'finishReason': 'STOP'
+                }]
+            }).encode('utf-8')
+            return dict(self.config)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.config), self._body
+
+    def count(self, outcome, received):
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            self.bytes_received += received
+
+    def stats(self):
+        with self._lock:
+            return {'counts': dict(self.counts), 'bytes_received': self.bytes_received}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 헤더와 본문을 따로 쓰므로 Nagle이 켜져 있으면 keep-alive 연결에서 응답마다 ~40ms 지연
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            return self._send_json(200, self.state.stats())
+        if self.path == '/_config':
+            return self._send_json(200, self.state.snapshot()[0])
+        self._send_json(404, error_body(404, 'NOT_FOUND', 'not found'))
+
+    def do_POST(self):
+        received = self._read_body()
+        if self.path == '/_config':
+            return self._send_json(200, self.state.update(json.loads(received or b'{}')))
+        if ':generateContent' not in self.path:
+            return self._send_json(404, error_body(404, 'NOT_FOUND', 'not found'))
+
+        config, body = self.state.snapshot()
+        key = None
+        if '?' in self.path:
+            for pair in self.path.split('?', 1)[1].split('&'):
+                name, _, value = pair.partition('=')
+                if name == 'key':
+                    key = value
+
+        if key is not None and key in config['invalid_keys']:
+            self.state.count('invalid_key', len(received))
+            return self._send_json(400, error_body(
+                400, 'INVALID_ARGUMENT', 'API key not valid. Please pass a valid API key.', 'API_KEY_INVALID'))
+
+        delay = config['latency_ms'] + random.uniform(0, config['jitter_ms'])
+        if random.random() < config['slow_rate']:
+            delay += config['slow_ms']
+        time.sleep(delay / 1000)
+
+        roll = random.random()
+        if roll < config['rate_limit_rate']:
+            self.state.count('rate_limited', len(received))
+            headers = {'Retry-After': str(config['retry_after'])} if config['retry_after'] else None
+            return self._send_json(429, error_body(429, 'RESOURCE_EXHAUSTED', 'Resource has been exhausted'), headers)
+        if roll < config['rate_limit_rate'] + config['error_rate']:
+            self.state.count('error', len(received))
+            return self._send_json(500, error_body(500, 'INTERNAL', 'Internal error encountered.'))
+
+        self.state.count('ok', len(received))
+        self._send_json(200, body)
+
+def start_stub(host='127.0.0.1', port=0, **config):
+    """스텁 서버를 백그라운드 스레드로 시작하고 (server, base_url) 반환"""
+    handler = type('BoundStubHandler', (StubHandler,), {'state': StubState(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-gemini', daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description='로컬 Gemini generateContent 스텁 서버')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_CONFIG['latency_ms'])
+    parser.add_argument('--jitter-ms', type=float, default=DEFAULT_CONFIG['jitter_ms'])
+    parser.add_argument('--slow-rate', type=float, default=DEFAULT_CONFIG['slow_rate'])
+    parser.add_argument('--slow-ms', type=float, default=DEFAULT_CONFIG['slow_ms'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_CONFIG['error_rate'])
+    parser.add_argument('--rate-limit-rate', type=float, default=DEFAULT_CONFIG['rate_limit_rate'])
+    parser.add_argument('--retry-after', type=int, default=DEFAULT_CONFIG['retry_after'])
+    parser.add_argument('--invalid-keys', default='', help='쉼표로 구분한 무효 키 목록')
+    parser.add_argument('--image-bytes', type=int, default=DEFAULT_CONFIG['image_bytes'])
+    args = parser.parse_args()
+
+    config = {name: value for name, value in vars(args).items() if name in DEFAULT_CONFIG}
+    config['invalid_keys'] = [k.strip() for k in args.invalid_keys.split(',') if k.strip()]
+    server, base_url = start_stub(args.host, args.port, **config)
+    print(f"🧪 스텁 Gemini 서버: {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
 let currentImageId = null;
 let userLikedImages = new Set();
 let currentPage = 1;
+let nextCursor = '';
 let currentSort = 'newest';
 let isLoading = false;
 let hasMore = true;
+let sinceCursor = '';
+let feedSource = null;
+let feedPollTimer = null;
+const FEED_POLL_INTERVAL = 30000;
 
 // 행별 그리드 레이아웃 클래스
 class RowGridLayout {
@@ -41,6 +46,22 @@ class RowGridLayout {
         this.itemsInCurrentRow++;
     }
     
+    prependItem(element) {
+        // 맨 앞에 끼워 넣고 행 구조 다시 계산
+        const firstItem = this.container.querySelector('.gallery-item');
+        if (!firstItem) {
+            this.addItem(element);
+            return;
+        }
+        firstItem.parentNode.insertBefore(element, firstItem);
+        this.relayout();
+    }
+    
+    removeItem(element) {
+        element.remove();
+        this.relayout();
+    }
+    
     createNewRow() {
         this.currentRow = document.createElement('div');
         this.currentRow.className = 'gallery-row';
@@ -144,6 +165,7 @@ document.addEventListener('DOMContentLoaded', function() {
             
             currentSort = this.dataset.sort;
             currentPage = 1;
+            nextCursor = '';
             hasMore = true;
             gridInstance.clear();
             loadImages(true);
@@ -195,7 +217,8 @@ async function loadImages(isInitial = false) {
     }
     
     try {
-        const response = await fetch(`/api/gallery?page=${currentPage}&per_page=15&sort=${currentSort}`);
+        // 커서 기반 페이지네이션 (깊은 페이지도 O(per_page))
+        const response = await fetch(`/api/gallery?cursor=${encodeURIComponent(nextCursor)}&per_page=15&sort=${currentSort}`);
         
         if (!response.ok) {
             throw new Error(`HTTP ${response.status}: ${response.statusText}`);
@@ -203,10 +226,17 @@ async function loadImages(isInitial = false) {
         
         const data = await response.json();
         
+        // 첫 페이지 시점부터의 변경분은 실시간 피드로 받음
+        if (isInitial && data.since_cursor) {
+            sinceCursor = data.since_cursor;
+            startGalleryFeed();
+        }
+        
         if (data.images && data.images.length > 0) {
             await appendImagesWithGrid(data.images);
             
             hasMore = data.has_more;
+            nextCursor = data.next_cursor || '';
             currentPage++;
             
             if (emptyGallery) emptyGallery.classList.add('hidden');
@@ -233,11 +263,15 @@ async function loadImages(isInitial = false) {
     }
 }
 
-async function appendImagesWithGrid(images) {
+async function appendImagesWithGrid(images, prepend = false) {
     const imagePromises = images.map((image, index) => {
         return new Promise((resolve) => {
             const galleryItem = document.createElement('div');
             galleryItem.className = 'gallery-item';
+            galleryItem.dataset.imageId = image.id;
+            
+            // 그리드에는 썸네일 사용 (고해상도 화면은 WebP 표시용 이미지), 원본은 상세 보기에서만
+            const tileSrc = image.thumbnail_image || image.result_image;
             
             // 스켈레톤 먼저 표시
             galleryItem.innerHTML = `
@@ -256,7 +290,11 @@ async function appendImagesWithGrid(images) {
             `;
             
             // 그리드에 추가
-            gridInstance.addItem(galleryItem);
+            if (prepend) {
+                gridInstance.prependItem(galleryItem);
+            } else {
+                gridInstance.addItem(galleryItem);
+            }
             
             // 이미지 미리 로드
             const img = galleryItem.querySelector('img');
@@ -277,7 +315,10 @@ async function appendImagesWithGrid(images) {
                     container.classList.add('square');
                 }
                 
-                img.src = image.result_image;
+                if (image.display_image) {
+                    img.srcset = `${tileSrc} 1x, ${image.display_image} 2x`;
+                }
+                img.src = tileSrc;
                 img.style.display = 'block';
                 
                 setTimeout(() => {
@@ -308,7 +349,7 @@ async function appendImagesWithGrid(images) {
             };
             
             setTimeout(() => {
-                preloadImg.src = image.result_image;
+                preloadImg.src = tileSrc;
             }, index * 50);
         });
     });
@@ -316,6 +357,93 @@ async function appendImagesWithGrid(images) {
     return Promise.resolve();
 }
 
+// 갤러리 실시간 업데이트 (SSE, 연결할 수 없으면 since 커서로 폴링)
+function startGalleryFeed() {
+    if (feedSource || feedPollTimer) return;
+    if (!window.EventSource) {
+        startFeedPolling();
+        return;
+    }
+    
+    feedSource = new EventSource(`/api/gallery/stream?since=${encodeURIComponent(sinceCursor)}`);
+    
+    const track = (handler) => (event) => {
+        if (event.lastEventId) sinceCursor = event.lastEventId;
+        handler(JSON.parse(event.data));
+    };
+    feedSource.addEventListener('added', track(addFeedImage));
+    feedSource.addEventListener('deleted', track(data => removeFeedImage(data.id)));
+    feedSource.addEventListener('likes', track(data => updateLikeCount(data.id, data.likes)));
+    feedSource.addEventListener('reset', track(() => reloadGallery()));
+    
+    feedSource.onerror = () => {
+        // 일시적인 끊김은 브라우저가 Last-Event-ID로 재연결, 완전히 닫히면 폴링으로 전환
+        if (feedSource.readyState === EventSource.CLOSED) {
+            feedSource = null;
+            startFeedPolling();
+        }
+    };
+}
+
+function startFeedPolling() {
+    if (feedPollTimer) return;
+    feedPollTimer = setInterval(pollGalleryFeed, FEED_POLL_INTERVAL);
+}
+
+async function pollGalleryFeed() {
+    if (!sinceCursor) return;
+    try {
+        const response = await fetch(`/api/gallery?since=${encodeURIComponent(sinceCursor)}`);
+        if (!response.ok) return;
+        
+        const data = await response.json();
+        sinceCursor = data.since_cursor || sinceCursor;
+        if (data.reset) {
+            reloadGallery();
+            return;
+        }
+        data.deleted.forEach(removeFeedImage);
+        Object.entries(data.likes).forEach(([imageId, likes]) => updateLikeCount(imageId, likes));
+        data.added.forEach(addFeedImage);
+    } catch (error) {
+        console.error('갤러리 업데이트 확인 오류:', error);
+    }
+}
+
+function addFeedImage(image) {
+    // 최신순일 때만 맨 앞에 추가 (다른 정렬은 다음 로드 때 반영)
+    if (currentSort !== 'newest') return;
+    if (document.querySelector(`.gallery-item[data-image-id="${image.id}"]`)) return;
+    
+    const emptyGallery = document.getElementById('emptyGallery');
+    if (emptyGallery) emptyGallery.classList.add('hidden');
+    appendImagesWithGrid([image], true);
+}
+
+function removeFeedImage(imageId) {
+    const galleryItem = document.querySelector(`.gallery-item[data-image-id="${imageId}"]`);
+    if (galleryItem) gridInstance.removeItem(galleryItem);
+}
+
+function updateLikeCount(imageId, likes) {
+    document.querySelectorAll(`.like-count[data-image-id="${imageId}"]`).forEach(el => {
+        el.textContent = `❤️ ${likes}`;
+    });
+    if (currentImageId === imageId) {
+        const likeCount = document.getElementById('likeCount');
+        if (likeCount) likeCount.textContent = likes;
+    }
+}
+
+function reloadGallery() {
+    if (isLoading) return;
+    currentPage = 1;
+    nextCursor = '';
+    hasMore = true;
+    gridInstance.clear();
+    loadImages(true);
+}
+
 // 나머지 함수들 (openModal, closeModal, likeImage, formatDate)는 기존과 동일하게 유지
 async function openModal(imageId) {
     if (!imageId) return;
@@ -423,7 +551,7 @@ async function likeImage() {
             likeBtn.style.color = '#dc2626';
             
             // 갤러리에서도 업데이트
-            document.querySelectorAll(`[data-image-id="${currentImageId}"]`).forEach(el => {
+            document.querySelectorAll(`.like-count[data-image-id="${currentImageId}"]`).forEach(el => {
                 el.textContent = `❤️ ${data.likes}`;
                 el.classList.add('liked');
             });
@@ -490,7 +618,7 @@ async function quickLike(event, imageId) {
             likeElement.textContent = `❤️ ${data.likes}`;
             likeElement.classList.add('liked');
             
-            document.querySelectorAll(`[data-image-id="${imageId}"]`).forEach(el => {
+            document.querySelectorAll(`.like-count[data-image-id="${imageId}"]`).forEach(el => {
                 el.textContent = `❤️ ${data.likes}`;
                 el.classList.add('liked');
             });
@@ -500,7 +628,7 @@ async function quickLike(event, imageId) {
             // 🎯 이미 좋아요 - 개수는 그대로, 상태만 변경
             likeElement.classList.add('liked');
             
-            document.querySelectorAll(`[data-image-id="${imageId}"]`).forEach(el => {
+            document.querySelectorAll(`.like-count[data-image-id="${imageId}"]`).forEach(el => {
                 el.classList.add('liked');
             });
             
@@ -629,8 +757,8 @@ function toggleImageSelection(event) {
     
     if (!img || !img.src) return;
     
-    // 이미지 ID 추출 (src에서)
-    const imageId = extractImageIdFromSrc(img.src);
+    // 이미지 ID (썸네일 주소는 원본 파일명과 다르므로 data 속성 사용)
+    const imageId = galleryItem.dataset.imageId || extractImageIdFromSrc(img.src);
     
     if (galleryItem.classList.contains('selected')) {
         galleryItem.classList.remove('selected');
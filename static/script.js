@@ -17,12 +17,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const formData = new FormData(form);
     
         try {
-            const response = await fetch('/generate', {
-                method: 'POST',
-                body: formData
-            });
-        
-            const data = await response.json();
+            const data = await submitGeneration(formData);
         
             if (data.success) {
                 document.getElementById('resultImage').src = data.result_image;
@@ -75,6 +70,31 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
+// 생성 작업을 등록하고 완료될 때까지 롱폴링으로 결과 대기
+async function submitGeneration(formData) {
+    const response = await fetch('/api/generate', {
+        method: 'POST',
+        body: formData
+    });
+    const job = await response.json();
+
+    if (response.status !== 202) {
+        return job;
+    }
+
+    while (true) {
+        const pollResponse = await fetch(`${job.status_url}?wait=25`);
+        const status = await pollResponse.json();
+
+        if (!pollResponse.ok) {
+            return status;
+        }
+        if (status.status === 'done' || status.status === 'failed') {
+            return status.result;
+        }
+    }
+}
+
 function previewImage(input, previewId) {
     const preview = document.getElementById(previewId);
     preview.innerHTML = '';